@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import types
+import timeit
+import argparse
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(threadName)s - %(message)s', level=logging.INFO)
+
+# Register the package without running wodbooker/__init__.py, which boots the whole web app
+_package = types.ModuleType('wodbooker')
+_package.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wodbooker')]
+sys.modules['wodbooker'] = _package
+
+
+def _report(name, total_seconds, number):
+    """
+    Log the time spent by a benchmarked operation
+    :param name: The name of the operation
+    :param total_seconds: The total time spent by all the runs
+    :param number: The number of runs
+    """
+    logging.info("%-40s %10.1f us/op", name, total_seconds / number * 1_000_000)
+
+
+def benchmark_login(paths, number):
+    """
+    Compare the targeted login form extractor with the full BeautifulSoup parser
+    :param paths: The saved login pages to parse
+    :param number: The number of times each page is parsed
+    """
+    from wodbooker.scraper import parse_login_form, parse_login_form_with_soup
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            content = f.read()
+        text = content.decode('utf-8')
+
+        fast_result = parse_login_form(text)
+        if fast_result != parse_login_form_with_soup(content):
+            logging.warning("Parsers disagree on %s. Fast parser returned %s", path, fast_result)
+
+        logging.info("%s (%d bytes)", path, len(content))
+        _report("parse_login_form", timeit.timeit(lambda: parse_login_form(text), number=number), number)
+        _report("parse_login_form_with_soup",
+                timeit.timeit(lambda: parse_login_form_with_soup(content), number=number), number)
+
+
+def _read_sse_messages(path):
+    """
+    Read the data of the messages of a recorded text/event-stream body
+    :param path: The file with the recorded stream
+    :return: The list with the data of each message
+    """
+    messages = []
+    lines = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('data:'):
+                lines.append(line[5:].lstrip(' '))
+            elif not line and lines:
+                messages.append('\n'.join(lines))
+                lines = []
+    if lines:
+        messages.append('\n'.join(lines))
+    return messages
+
+
+def benchmark_signalr(paths, number, targets):
+    """
+    Compare decoding every SignalR record with filtering records by target before decoding them
+    :param paths: The recorded hub streams
+    :param number: The number of times each stream is processed
+    :param targets: The targets being waited for
+    """
+    from wodbooker.scraper import SignalRRecordSplitter
+
+    def decode_all(messages):
+        found = 0
+        for message in messages:
+            for record in filter(None, message.split('\u001e')):
+                data = json.loads(record)
+                found += data.get('target') in targets
+        return found
+
+    def filter_by_target(messages):
+        found = 0
+        splitter = SignalRRecordSplitter()
+        for message in messages:
+            for record in splitter.feed(message):
+                found += record.get_target() in targets
+        return found
+
+    for path in paths:
+        messages = _read_sse_messages(path)
+        if decode_all(messages) != filter_by_target(messages):
+            logging.warning("Parsers disagree on %s", path)
+
+        logging.info("%s (%d messages)", path, len(messages))
+        _report("json.loads per record", timeit.timeit(lambda: decode_all(messages), number=number), number)
+        _report("SignalRRecordSplitter",
+                timeit.timeit(lambda: filter_by_target(messages), number=number), number)
+
+
+def benchmark_replay(path, url, booking_datetime, speed):
+    """
+    Replay a recorded booking against the scraper, without reaching WodBuster
+    :param path: The recording made with WODBUSTER_RECORD_FILE
+    :param url: The WodBuster URL of the box used in the recording
+    :param booking_datetime: The naive datetime of the recorded booking
+    :param speed: The timing acceleration factor. 0 replays without any delay
+    """
+    import pickle
+    import time
+    from datetime import datetime
+    from requests.cookies import RequestsCookieJar
+    from wodbooker.scraper import Scraper, set_transport
+    from wodbooker.recording import ReplayAdapter
+
+    set_transport(ReplayAdapter(path, speed))
+    # The recording holds no credentials, so any are accepted by the replayed responses
+    scraper = Scraper('replay', password='replay', cookie=pickle.dumps(RequestsCookieJar()))
+    started = time.perf_counter()
+    scraper.login()
+    booked = scraper.book(url, datetime.fromisoformat(booking_datetime))
+    logging.info("Booking replayed in %.3f s. Result: %s", time.perf_counter() - started, booked)
+
+
+class _BenchmarkScraper():
+
+    def __init__(self, clock, bookings):
+        """
+        Scraper booking every class at once without reaching WodBuster. It records when each class
+        is booked
+        :param clock: The simulated clock
+        :param bookings: List where the email, class datetime and booking datetime are appended
+        """
+        self._clock = clock
+        self._bookings = bookings
+        self.email = None
+
+    def book_many(self, url, booking_datetimes):
+        now = self._clock.now(booking_datetimes[0].tzinfo)
+        for booking_datetime in booking_datetimes:
+            self._bookings.append((self.email, booking_datetime, now))
+        return {booking_datetime.strftime('%H:%M:%S'): True for booking_datetime in booking_datetimes}
+
+    def get_last_book_latency(self):
+        return 0
+
+    def get_cookies(self):
+        return None
+
+
+def benchmark_booking_loops(bookings, users, weeks, seed):
+    """
+    Run the booking loops of many weekly bookings for several weeks with a simulated clock. The
+    loops are the real ones, with their own database, waits and booking batches, and only the
+    scraper is replaced, so no request reaches WodBuster. The clock jumps to the next deadline
+    once every loop is waiting. Checks that every class is booked once a week, after its opening
+    and within the anti-bot delay, DST changes included
+    :param bookings: The number of random bookings
+    :param users: The number of users the bookings are spread across
+    :param weeks: The number of simulated weeks
+    :param seed: The seed of the random bookings
+    """
+    import random
+    import tempfile
+    import time as _time
+    from datetime import datetime, time, timedelta
+    from flask import Flask
+    from wodbooker import booker
+    from wodbooker.clock import SimulatedClock, set_clock
+    from wodbooker.models import db, User, Booking
+
+    rng = random.Random(seed)
+    start = booker._MADRID_TZ.localize(datetime(2024, 1, 1))
+    end = start + timedelta(weeks=weeks)
+    clock = SimulatedClock(start)
+    set_clock(clock)
+    logging.getLogger('wodbooker').setLevel(logging.WARNING)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'db.sqlite')
+    db.init_app(app)
+
+    booked = []
+    scrapers = {}
+
+    def get_scraper(email, cookie=None):
+        if email not in scrapers:
+            scrapers[email] = _BenchmarkScraper(clock, booked)
+            scrapers[email].email = email
+        return scrapers[email]
+
+    booker.get_scraper = get_scraper
+
+    with app.app_context():
+        db.create_all()
+        # Each user books at most one class per slot, opened with the same rules of their box
+        slots = [(dow, time(hour, minute)) for dow in range(7) for hour in range(6, 22) for minute in (0, 30)]
+        for index in range(users):
+            db.session.add(User(email=f"user{index}@wodbooker.local"))
+        db.session.commit()
+        rules = {user.id: (rng.randint(1, 7), time(rng.randrange(24), rng.choice((0, 30))))
+                 for user in User.query.all()}
+        user_slots = {user_id: rng.sample(slots, len(slots)) for user_id in rules}
+        for index in range(bookings):
+            user_id = list(rules)[index % users]
+            dow, class_time = user_slots[user_id].pop()
+            offset, available_at = rules[user_id]
+            db.session.add(Booking(user_id=user_id, url="https://benchmark.wodbuster.com", dow=dow, time=class_time,
+                                   offset=offset, available_at=available_at, is_active=True))
+        db.session.commit()
+        expected = {(booking.user.email, booking.dow, booking.time): booking for booking in Booking.query.all()}
+
+        started = _time.perf_counter()
+        steps = 0
+        booker.start_booking_loops(Booking.query.all())
+        while clock.advance_to_next_deadline(bookings, end, 60):
+            steps += 1
+        elapsed = _time.perf_counter() - started
+
+        if clock.now(booker._MADRID_TZ) < end:
+            logging.error("The booking loops stopped waiting before %s", end)
+        booker.stop_booking_loops(Booking.query.all())
+
+    errors = dst_shifts = 0
+    last_book_dates = {}
+    for email, booking_datetime, booked_at in booked:
+        booking = expected.get((email, booking_datetime.weekday(), booking_datetime.time()))
+        if not booking:
+            errors += 1
+            logging.warning("Unexpected class booked for %s: %s", email, booking_datetime)
+            continue
+        opens_at = booker._get_book_available_at(booking_datetime.date(), booking.offset, booking.available_at)
+        last_book_date = last_book_dates.get(booking.id)
+        if booked_at < max(opens_at, start) or booked_at > max(opens_at, start) + timedelta(seconds=61) \
+                or (last_book_date and booking_datetime.date() - last_book_date != timedelta(days=7)):
+            errors += 1
+            logging.warning("Unexpected booking of %s: %s booked at %s after %s", booking.id, booking_datetime,
+                            booked_at, last_book_date)
+        if last_book_date and opens_at.time() != booking.available_at:
+            dst_shifts += 1
+        last_book_dates[booking.id] = booking_datetime.date()
+
+    logging.info("%d bookings of %d users, %d weeks: %d classes booked in %d clock steps, %d errors, "
+                 "%d openings shifted by DST changes", bookings, users, weeks, len(booked), steps, errors, dst_shifts)
+    _report("booking loop cycle", elapsed, max(len(booked), 1))
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-n', '--number', type=int, default=1000, help='Number of runs per operation')
+    subparsers = argparser.add_subparsers(dest='benchmark', required=True)
+
+    login_parser = subparsers.add_parser('login', help='Login page parsing')
+    login_parser.add_argument('paths', nargs='+', help='Saved login.aspx pages')
+
+    signalr_parser = subparsers.add_parser('signalr', help='SignalR hub stream parsing')
+    signalr_parser.add_argument('paths', nargs='+', help='Recorded text/event-stream bodies')
+    signalr_parser.add_argument('-t', '--target', action='append', dest='targets',
+                                default=None, help='Expected event target (repeatable)')
+
+    replay_parser = subparsers.add_parser('replay', help='Recorded booking replay')
+    replay_parser.add_argument('path', help='Recording made with WODBUSTER_RECORD_FILE')
+    replay_parser.add_argument('-u', '--url', required=True, help='WodBuster URL of the box')
+    replay_parser.add_argument('-d', '--datetime', required=True, help='Booked class, e.g. 2024-01-15T18:00')
+    replay_parser.add_argument('-s', '--speed', type=float, default=0, help='Timing acceleration factor (0: no delays)')
+
+    loops_parser = subparsers.add_parser('booking-loops', help='Booking loops under a simulated clock')
+    loops_parser.add_argument('-b', '--bookings', type=int, default=20, help='Number of random bookings')
+    loops_parser.add_argument('-u', '--users', type=int, default=5, help='Number of users owning the bookings')
+    loops_parser.add_argument('-w', '--weeks', type=int, default=2, help='Number of simulated weeks')
+    loops_parser.add_argument('--seed', type=int, default=0, help='Seed of the random bookings')
+
+    args = argparser.parse_args()
+
+    if args.benchmark == 'login':
+        benchmark_login(args.paths, args.number)
+    elif args.benchmark == 'signalr':
+        benchmark_signalr(args.paths, args.number, args.targets or ['changedBooking'])
+    elif args.benchmark == 'replay':
+        benchmark_replay(args.path, args.url, args.datetime, args.speed)
+    elif args.benchmark == 'booking-loops':
+        benchmark_booking_loops(args.bookings, args.users, args.weeks, args.seed)
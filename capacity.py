@@ -0,0 +1,166 @@
+import json
+import argparse
+import calendar
+import logging
+from collections import Counter, defaultdict
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+logging.basicConfig(format='%(asctime)s - %(threadName)s - %(message)s', level=logging.INFO)
+
+_MINUTES_PER_DAY = 60 * 24
+_MINUTES_PER_WEEK = _MINUTES_PER_DAY * 7
+# Threads running besides the bookers: cleaner, prefetcher, mailer and the background job workers
+_FIXED_THREADS = 3 + 8
+# WodBuster requests per batch of classes of a user for the same box and day: cookie check and LoadClass
+_REQUESTS_PER_BATCH = 2
+# WodBuster requests per booked class
+_REQUESTS_PER_BOOKING = 1
+# WodBuster requests per SSE subscription: negotiate, stream and the two handshake commands
+_REQUESTS_PER_SUBSCRIPTION = 4
+# Booking attempts are spread by the anti-bot delay, between 15 and 60 seconds after the opening
+_ATTEMPT_SPREAD_SECONDS = 45
+
+
+def _parse_minutes(value):
+    """
+    Get the minute of the day of a time stored by SQLite as HH:MM:SS
+    :param value: The stored time
+    """
+    hours, minutes = str(value).split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def _format_minute(minute_of_week):
+    day, minute = divmod(minute_of_week % _MINUTES_PER_WEEK, _MINUTES_PER_DAY)
+    return f"{calendar.day_abbr[day]} {minute // 60:02d}:{minute % 60:02d}"
+
+
+def load_active_bookings(database):
+    """
+    Load the active bookings
+    :param database: The SQLAlchemy database URL
+    :return: The list of active bookings as dicts
+    """
+    engine = create_engine(database)
+    with engine.connect() as conn:
+        rows = conn.execute(text("select user_id, url, dow, time, offset, available_at from booking "
+                                 "where is_active = 1")).mappings().all()
+    return [dict(row) for row in rows]
+
+
+def compute_capacity(bookings):
+    """
+    Compute the expected load of the booking engine along the week
+    :param bookings: The active bookings
+    :return: A dict with the expected load
+    """
+    opens = Counter()
+    opens_by_box = defaultdict(Counter)
+    attempts_by_minute = Counter()
+    subscriptions_delta = [0] * (_MINUTES_PER_WEEK + 1)
+
+    for booking in bookings:
+        open_minute = ((booking['dow'] - booking['offset']) * _MINUTES_PER_DAY
+                       + _parse_minutes(booking['available_at'])) % _MINUTES_PER_WEEK
+        opens[open_minute] += 1
+        opens_by_box[booking['url']][open_minute] += 1
+        # Classes of the same user, box and day are booked together
+        attempts_by_minute[(open_minute, booking['user_id'], booking['url'], booking['dow'])] += 1
+
+        # Worst case: the subscription lasts from the opening until the class when the class is full.
+        # Openings more than a week ahead overlap the subscriptions of the following weeks
+        window = max(booking['offset'] * _MINUTES_PER_DAY + _parse_minutes(booking['time'])
+                     - _parse_minutes(booking['available_at']), 0)
+        weeks, window = divmod(window, _MINUTES_PER_WEEK)
+        subscriptions_delta[0] += weeks
+        end = open_minute + window
+        subscriptions_delta[open_minute] += 1
+        if end <= _MINUTES_PER_WEEK:
+            subscriptions_delta[end] -= 1
+        else:
+            subscriptions_delta[_MINUTES_PER_WEEK] -= 1
+            subscriptions_delta[0] += 1
+            subscriptions_delta[end - _MINUTES_PER_WEEK] -= 1
+
+    subscriptions_by_hour = [0] * (_MINUTES_PER_WEEK // 60)
+    active_subscriptions = 0
+    for minute in range(_MINUTES_PER_WEEK):
+        active_subscriptions += subscriptions_delta[minute]
+        hour = minute // 60
+        subscriptions_by_hour[hour] = max(subscriptions_by_hour[hour], active_subscriptions)
+
+    batches_by_minute = Counter(minute for minute, _, _, _ in attempts_by_minute)
+    # Worst case: every booking also subscribes to the SSE hub because the classes are not published yet
+    requests_by_minute = {minute: batches_by_minute[minute] * _REQUESTS_PER_BATCH
+                          + count * (_REQUESTS_PER_BOOKING + _REQUESTS_PER_SUBSCRIPTION)
+                          for minute, count in opens.items()}
+
+    return {
+        "active_bookings": len(bookings),
+        "threads": len(bookings) + _FIXED_THREADS,
+        "opens": opens,
+        "opens_by_box": opens_by_box,
+        "subscriptions_by_hour": subscriptions_by_hour,
+        "requests_by_minute": requests_by_minute,
+    }
+
+
+def report(capacity, top):
+    """
+    Log the expected load
+    :param capacity: The result of compute_capacity
+    :param top: The number of busiest minutes and hours to show
+    """
+    logging.info("Active bookings: %d. Threads: %d (one per booking plus %d fixed)",
+                 capacity["active_bookings"], capacity["threads"], _FIXED_THREADS)
+
+    logging.info("Busiest booking openings:")
+    for minute, count in capacity["opens"].most_common(top):
+        requests = capacity["requests_by_minute"][minute]
+        logging.info("  %s: %4d openings, ~%d WodBuster requests (%.1f req/s over %d s)", _format_minute(minute),
+                     count, requests, requests / _ATTEMPT_SPREAD_SECONDS, _ATTEMPT_SPREAD_SECONDS)
+
+    logging.info("Most concurrent openings per box:")
+    boxes = sorted(capacity["opens_by_box"].items(), key=lambda item: -max(item[1].values()))
+    for url, opens in boxes[:top]:
+        minute, count = opens.most_common(1)[0]
+        logging.info("  %s: %d at %s", url, count, _format_minute(minute))
+
+    logging.info("Hours with most SSE connections (worst case, every class full):")
+    hours = sorted(range(len(capacity["subscriptions_by_hour"])), key=lambda h: -capacity["subscriptions_by_hour"][h])
+    for hour in hours[:top]:
+        logging.info("  %s: %d", _format_minute(hour * 60), capacity["subscriptions_by_hour"][hour])
+
+
+def to_json(capacity):
+    """
+    Convert the expected load to a JSON serializable dict
+    :param capacity: The result of compute_capacity
+    """
+    return {
+        "active_bookings": capacity["active_bookings"],
+        "threads": capacity["threads"],
+        "opens": {_format_minute(minute): count for minute, count in sorted(capacity["opens"].items())},
+        "opens_by_box": {url: {_format_minute(minute): count for minute, count in sorted(opens.items())}
+                         for url, opens in capacity["opens_by_box"].items()},
+        "sse_connections_by_hour": {_format_minute(hour * 60): count
+                                    for hour, count in enumerate(capacity["subscriptions_by_hour"]) if count},
+        "requests_by_minute": {_format_minute(minute): count
+                               for minute, count in sorted(capacity["requests_by_minute"].items())},
+    }
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Expected load of the booking engine along the week')
+    argparser.add_argument('--database', default='sqlite:///instance/db.sqlite', help='Database URL')
+    argparser.add_argument('--top', type=int, default=10, help='Number of busiest minutes and hours to show')
+    argparser.add_argument('--json', action='store_true', help='Print the whole load as JSON')
+
+    args = argparser.parse_args()
+
+    result = compute_capacity(load_active_bookings(args.database))
+    if args.json:
+        print(json.dumps(to_json(result), indent=2))
+    else:
+        report(result, args.top)
@@ -1,64 +1,223 @@
 import os
+import re
+import time
+import sqlite3
 import argparse
 import logging
-from sqlalchemy import create_engine
+import importlib.util
+from datetime import datetime
+from sqlalchemy import create_engine, event
 from sqlalchemy.sql import text
-from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy.exc import SQLAlchemyError
 
 logging.basicConfig(format='%(asctime)s - %(threadName)s - %(message)s', level=logging.INFO)
 
-def get_migrate_scripts(version):
+_MIGRATIONS_DIR = 'migrations'
+# Seconds SQLite waits for the booking engine to release the database before failing
+_BUSY_TIMEOUT = 30
+_DEFAULT_CHUNK_SIZE = 1000
+# Seconds between chunks of a data migration, so the booking engine can write meanwhile
+_DEFAULT_CHUNK_PAUSE = 0.1
+
+
+def _parse_version(version):
+    """
+    Get a sortable key of a version such as v1.10.0
+    :param version: The version
+    """
+    return tuple(int(part) if part.isdigit() else part for part in re.findall(r'\d+|[^\d.]+', version.lstrip('v')))
+
+
+def get_migrate_scripts(until=None):
     """
-    Get the migration scripts for the given version
-    :param version: Version to migrate to
+    Get the migration scripts sorted by version and, within a version, by name
+    :param until: If provided, the scripts of later versions are ignored
+    :return: A list of (version, script name, path) tuples
     """
-    _migrations = {}
+    _migrations = []
 
-    if not os.path.exists(f'migrations/{version}'):
+    if not os.path.exists(_MIGRATIONS_DIR):
         return _migrations
 
-    for file in os.listdir(f'migrations/{version}'):
-        if file.endswith('.sql'):
-            with open(f'migrations/{version}/{file}', 'r', encoding='utf-8') as f:
-                _migrations[file] = f.read()
+    versions = sorted((version for version in os.listdir(_MIGRATIONS_DIR)
+                       if os.path.isdir(os.path.join(_MIGRATIONS_DIR, version))), key=_parse_version)
+    for version in versions:
+        if until and _parse_version(version) > _parse_version(until):
+            break
+        for file in sorted(os.listdir(os.path.join(_MIGRATIONS_DIR, version))):
+            if file.endswith('.sql') or file.endswith('.py'):
+                _migrations.append((version, file, os.path.join(_MIGRATIONS_DIR, version, file)))
 
     return _migrations
 
 
-def execute_migration(_migrations):
+def split_statements(script):
+    """
+    Split a SQL script into statements. Semicolons inside strings or triggers don't end a statement
+    :param script: The SQL script
+    """
+    statements = []
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \t\r\n;'):
+                statements.append(statement.strip())
+            statement = ''
+    if statement.strip(' \t\r\n;'):
+        statements.append(statement.strip())
+    return statements
+
+
+def create_migration_engine(database):
+    """
+    Create an engine whose transactions also cover DDL statements. The pysqlite driver only opens
+    transactions before DML statements, so transactions are begun explicitly
+    :param database: The SQLAlchemy database URL
+    """
+    engine = create_engine(database, connect_args={'timeout': _BUSY_TIMEOUT})
+
+    @event.listens_for(engine, 'connect')
+    def _disable_driver_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _begin_immediate(conn):
+        # Take the write lock at once so a migration never fails halfway on a busy database
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
+
+
+def _ensure_migrations_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text("create table if not exists applied_migration (version varchar(32) not null, "
+                          "script varchar(128) not null, applied_at datetime, primary key (version, script))"))
+
+
+def get_applied_migrations(engine):
     """
-    Execute the given migration scripts
-    :param migrations: Dictionary with the migration scripts
+    Get the migration scripts already applied to the database
+    :param engine: The database engine
+    :return: A set of (version, script name) tuples
     """
-    engine = create_engine('sqlite:///instance/db.sqlite')
-    conn = engine.connect()
+    _ensure_migrations_table(engine)
+    with engine.connect() as conn:
+        return {(row.version, row.script) for row in conn.execute(text("select version, script from applied_migration"))}
+
+
+def _record_migration(conn, version, name):
+    conn.execute(text("insert into applied_migration (version, script, applied_at) values (:version, :script, :now)"),
+                 {"version": version, "script": name, "now": datetime.now()})
+
 
-    for name, script in _migrations.items():
-        logging.info("Executing migration script %s", name)
-        script_statements = filter(lambda x: x, script.split(";"))
-        for statement in script_statements:
-            try:
-                conn.execute(text(statement))
-            except OperationalError as e:
-                logging.error("Error executing migration %s: %s", name, e)
-                conn.close()
-                return
-            except SQLAlchemyError as e:
-                logging.error("Error executing migration %s: %s", name, e)
-                conn.close()
-                return
+def _load_data_migration(path):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-        logging.info("Migration %s executed successfully", name)
 
-    conn.commit()
-    conn.close()
+def _execute_sql_migration(engine, version, name, path):
+    """
+    Execute a SQL script and record it as applied, all in the same transaction
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        statements = split_statements(f.read())
+
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+        _record_migration(conn, version, name)
+
+
+def _execute_data_migration(engine, version, name, path, chunk_size, chunk_pause):
+    """
+    Execute a data migration in chunks, each one in its own short transaction, so the database is
+    never locked for long. The migration is recorded as applied once a chunk processes no rows.
+
+    A data migration is a Python file defining migrate_chunk(conn, chunk_size) -> int, which
+    migrates up to chunk_size rows and returns the number of rows migrated. Chunks must only pick
+    rows not migrated yet, so an interrupted migration resumes where it stopped. The file may also
+    define CHUNK_SIZE to override the default chunk size
+    """
+    module = _load_data_migration(path)
+    chunk_size = getattr(module, 'CHUNK_SIZE', chunk_size)
+
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            migrated = module.migrate_chunk(conn, chunk_size)
+            if not migrated:
+                _record_migration(conn, version, name)
+                break
+        total += migrated
+        logging.info("Migration %s/%s: %d rows migrated", version, name, total)
+        time.sleep(chunk_pause)
+
+
+def execute_migration(engine, _migrations, chunk_size=_DEFAULT_CHUNK_SIZE, chunk_pause=_DEFAULT_CHUNK_PAUSE):
+    """
+    Execute the given migration scripts not applied yet, in order. Each script runs in its own
+    transaction and the execution stops at the first failing script
+    :param engine: The database engine
+    :param _migrations: List of (version, script name, path) tuples, as returned by get_migrate_scripts
+    :param chunk_size: Number of rows migrated per transaction by data migrations
+    :param chunk_pause: Seconds between the chunks of data migrations
+    :return: True if every script was applied
+    """
+    applied = get_applied_migrations(engine)
+
+    for version, name, path in _migrations:
+        if (version, name) in applied:
+            continue
+
+        logging.info("Executing migration script %s/%s", version, name)
+        try:
+            if name.endswith('.py'):
+                _execute_data_migration(engine, version, name, path, chunk_size, chunk_pause)
+            else:
+                _execute_sql_migration(engine, version, name, path)
+        except SQLAlchemyError as e:
+            logging.error("Error executing migration %s/%s: %s", version, name, e)
+            return False
+
+        logging.info("Migration %s/%s executed successfully", version, name)
+
+    return True
+
+
+def mark_applied(engine, _migrations):
+    """
+    Record the given migration scripts as applied without executing them. Used on databases
+    created or migrated before migrations were recorded
+    :param engine: The database engine
+    :param _migrations: List of (version, script name, path) tuples
+    """
+    applied = get_applied_migrations(engine)
+    with engine.begin() as conn:
+        for version, name, _ in _migrations:
+            if (version, name) not in applied:
+                _record_migration(conn, version, name)
+                logging.info("Migration %s/%s marked as applied", version, name)
 
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
-    argparser.add_argument('version', type=str, help='Version to migrate to')
+    argparser.add_argument('version', type=str, nargs='?', help='Version to migrate to. All versions by default')
+    argparser.add_argument('--database', default='sqlite:///instance/db.sqlite', help='Database URL')
+    argparser.add_argument('--baseline', action='store_true',
+                           help='Mark the migrations up to the version as applied without executing them')
+    argparser.add_argument('--chunk-size', type=int, default=_DEFAULT_CHUNK_SIZE,
+                           help='Rows migrated per transaction by data migrations')
+    argparser.add_argument('--chunk-pause', type=float, default=_DEFAULT_CHUNK_PAUSE,
+                           help='Seconds between the chunks of data migrations')
 
     args = argparser.parse_args()
 
+    migration_engine = create_migration_engine(args.database)
     migrations = get_migrate_scripts(args.version)
-    execute_migration(migrations)
+    if args.baseline:
+        mark_applied(migration_engine, migrations)
+    elif not execute_migration(migration_engine, migrations, args.chunk_size, args.chunk_pause):
+        raise SystemExit(1)
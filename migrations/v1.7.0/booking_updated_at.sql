@@ -0,0 +1 @@
+alter table booking add column updated_at datetime;
@@ -0,0 +1 @@
+create table box (url varchar(128) not null, name varchar(128), sse_server varchar(256), updated_at datetime, primary key (url));
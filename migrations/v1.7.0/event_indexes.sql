@@ -0,0 +1,2 @@
+create index ix_event_booking_id_date_id on event (booking_id, date, id);
+create index ix_event_date_id on event (date, id);
@@ -0,0 +1,2 @@
+create table outgoing_email (id integer not null, delivery_key varchar(256), "to" varchar(120), subject varchar(256), html text, text text, status varchar(16), attempts integer, next_attempt_at datetime, created_at datetime, sent_at datetime, primary key (id), unique (delivery_key));
+create index ix_outgoing_email_status_next_attempt_at on outgoing_email (status, next_attempt_at);
@@ -0,0 +1,2 @@
+create table schedule (booking_id integer not null, class_datetime datetime, fire_at datetime, waiter varchar(16), loop_id integer, updated_at datetime, primary key (booking_id), foreign key(booking_id) references booking (id));
+create index ix_schedule_fire_at on schedule (fire_at);
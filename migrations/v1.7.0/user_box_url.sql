@@ -0,0 +1 @@
+alter table user add column box_url varchar(128);
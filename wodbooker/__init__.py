@@ -13,13 +13,17 @@ from flask_admin import Admin
 import flask_login as login
 from flask_babel import Babel
 from flask_wtf.csrf import CSRFProtect
-from .views import MyAdminIndexView, BookingAdmin, EventView, UserView
-from .models import User, Booking, Event, db
-from .booker import start_booking_loop
+from .views import MyAdminIndexView, BookingAdmin, EventView, UserView, StatusView
+from .models import User, Booking, Event, Schedule, db
+from .booker import start_booking_loop, prefetch_classes_loop
 from .mailer import process_maling_queue
+from .scraper import set_transport
+from .recording import RecordingAdapter, ReplayAdapter
+from .logs import configure_logging
 
 # Configure logging
-logging.basicConfig(format='%(asctime)s - %(threadName)s - %(message)s', level=logging.INFO)
+configure_logging(os.environ.get('LOG_FORMAT'), os.environ.get('LOG_LEVELS'))
+_LOGGER = logging.getLogger(__name__)
 
 # Get version
 __git_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/.git"
@@ -50,6 +54,14 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['CSRF_ENABLED'] = True
 app.config['RECAPTCHA_PUBLIC_KEY'] = os.environ.get('RECAPTCHA_PUBLIC_KEY')
 app.config['RECAPTCHA_PRIVATE_KEY'] = os.environ.get('RECAPTCHA_PRIVATE_KEY')
+app.config['STATUS_API_TOKEN'] = os.environ.get('STATUS_API_TOKEN')
+
+# Record the traffic with WodBuster or replay a previous recording instead of reaching WodBuster
+if os.environ.get('WODBUSTER_REPLAY_FILE'):
+    set_transport(ReplayAdapter(os.environ['WODBUSTER_REPLAY_FILE'],
+                                float(os.environ.get('WODBUSTER_REPLAY_SPEED', 1))))
+elif os.environ.get('WODBUSTER_RECORD_FILE'):
+    set_transport(RecordingAdapter(os.environ['WODBUSTER_RECORD_FILE']))
 
 # Build a sample db on the fly, if one does not exist yet.
 app_dir = op.realpath(os.path.dirname(__file__))
@@ -90,7 +102,7 @@ def check_session_expired():
                 if datetime.now() > expiration_date:
                     login.logout_user()
             except (StopIteration, TypeError):
-                logging.exception("Error while getting expiration date of cookie")
+                _LOGGER.exception("Error while getting expiration date of cookie")
 
 
 @app.before_request
@@ -119,20 +131,21 @@ admin = Admin(app, name='WodBooker', index_view=MyAdminIndexView(url="/"),
 admin.add_view(BookingAdmin(Booking, db.session, 'Reservas'))
 admin.add_view(EventView(Event, db.session, 'Eventos'))
 admin.add_view(UserView(User, db.session, 'Usuarios'))
+admin.add_view(StatusView(name='Estado', endpoint='status'))
 
-# Start booking loop
+# Start booking loop, soonest scheduled bookings first
 with app.app_context():
-    _bookings = db.session.query(Booking).all()
+    _bookings = db.session.query(Booking).outerjoin(Schedule).filter(Booking.is_active.is_(True)) \
+        .order_by(Schedule.fire_at.is_(None), Schedule.fire_at).all()
     for _booking in _bookings:
-        if _booking.is_active:
-            start_booking_loop(_booking)
+        start_booking_loop(_booking)
 
 # Start events cleaning loop
 def _cleaning_loop(app_context):
     app_context.push()
     with app_context:
         while True:
-            logging.info("Cleaning events older than 15 days")
+            _LOGGER.info("Cleaning events older than 15 days")
             bookings = db.session.query(Booking).all()
             for booking in bookings:
                 events_older_than_15_days = list(filter(lambda x: x.date < datetime.now() - timedelta(days=15),
@@ -148,6 +161,12 @@ thread_cleaner = threading.Thread(target=_cleaning_loop,
                                   daemon=True, name="dbcleaner")
 thread_cleaner.start()
 
+thread_prefetcher = threading.Thread(target=prefetch_classes_loop,
+                                     args=(app.app_context(),),
+                                     daemon=True, name="prefetcher")
+thread_prefetcher.start()
+
 thread_mailer = threading.Thread(target=process_maling_queue,
+                                 args=(app.app_context(),),
                                  daemon=True, name="mailer")
 thread_mailer.start()
@@ -1,30 +1,50 @@
 from datetime import datetime, timedelta, date, time
 from abc import ABC, abstractmethod
+import re
 import random
 import logging
-import pause
+import itertools
+import threading
+from collections import Counter
 import pytz
 from flask import current_app as app
-from func_timeout import StoppableThread
 from requests.exceptions import RequestException
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .constants import EventMessage, UNEXPECTED_ERROR_MAIL_SUBJECT, \
     UNEXPECTED_ERROR_MAIL_BODY, FULL_CLASS_BOOKED_MAIL_SUBJECT, \
     FULL_CLASS_BOOKED_MAIL_BODY, ERROR_AUTOHEALED_MAIL_SUBJECT, \
     ERROR_AUTOHEALED_MAIL_BODY, CLASS_BOOKED_MAIL_SUBJECT, \
     CLASS_BOOKED_MAIL_BODY
-from .scraper import get_scraper, Scraper
+from .scraper import get_scraper, get_cached_classes, hold_scraper, release_scraper, Scraper
+from .cancellation import CancellationToken
+from .clock import get_clock
+from .status import claim_booking_status, update_booking_status, remove_booking_status
+from .logs import set_log_context, clear_log_context
 from .mailer import send_email, ErrorEmail, SuccessAfterErrorEmail, SuccessEmail
 from .exceptions import BookingNotAvailable, InvalidWodBusterResponse, \
     ClassIsFull, LoginError, PasswordRequired, InvalidBox, \
-    ClassNotFound, BookingFailed
-from .models import db, Booking, Event
+    ClassNotFound, BookingFailed, OperationCancelled
+from .models import db, Booking, Event, User, Schedule
+
+_LOGGER = logging.getLogger(__name__)
 
 _MADRID_TZ = pytz.timezone('Europe/Madrid')
 
 _MAX_ERRORS = 5
+_BATCH_POLL_INTERVAL = 0.1
+_PREFETCH_INTERVAL = 60 * 15
+_PREFETCH_HORIZON = timedelta(hours=6)
+_PREFETCH_REQUEST_INTERVAL = 10
+_PREFETCH_MAX_AGE = _PREFETCH_INTERVAL * 2
+# Class ids of a day don't change once published, so old fetches are enough to filter events
+_CLASS_IDS_MAX_AGE = 60 * 60 * 24
+_PAYLOAD_HOUR_REGEX = re.compile(r'\b\d{2}:\d{2}')
 
 __CURRENT_THREADS = {
 }
+# Increasing id of every loop started, so the schedule of a loop is never replaced by an older one
+__LOOP_IDS = itertools.count(1)
 
 
 def _get_next_date_for_weekday(base_date: date, weekday: int) -> date:
@@ -47,7 +67,7 @@ def _get_datetime_to_book(last_booking_date: date, dow: int, booking_time: time)
     :param booking_time: The time to book
     :return: The datetime to book
     """
-    now = datetime.now(_MADRID_TZ)
+    now = get_clock().now(_MADRID_TZ)
     base_date = now.date() if not last_booking_date else last_booking_date + timedelta(days=1)
     day_to_book = _get_next_date_for_weekday(base_date, dow)
     datetime_to_book = _MADRID_TZ.localize(datetime.combine(day_to_book, booking_time))
@@ -59,28 +79,287 @@ def _get_datetime_to_book(last_booking_date: date, dow: int, booking_time: time)
     return datetime_to_book
 
 
-class _StopThreadException(BaseException):
-    pass
+def _get_book_available_at(day_to_book: date, offset: int, available_at: time) -> datetime:
+    """
+    Get the datetime when the booking of a class opens
+    :param day_to_book: The day of the class
+    :param offset: The number of days in advance the class can be booked
+    :param available_at: The time of the day the booking opens
+    :return: The datetime when the booking opens
+    """
+    return _MADRID_TZ.localize(datetime.combine(day_to_book - timedelta(days=offset), available_at))
+
+
+class _Snapshot():
+    """
+    Detached and immutable copy of the fields of a model, so long running threads don't keep
+    ORM instances attached to a session
+    """
+    __slots__ = ()
+
+    def __init__(self, model, **overrides) -> None:
+        """
+        :param model: The model instance to copy
+        :param overrides: Values to use for some fields instead of the model ones
+        """
+        for field in self.__slots__:
+            value = overrides[field] if field in overrides else getattr(model, field)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+
+class _UserSnapshot(_Snapshot):
+    __slots__ = ('id', 'email', 'cookie', 'mail_permission_success', 'mail_permission_failure')
+
+
+class _BookingSnapshot(_Snapshot):
+    __slots__ = ('id', 'dow', 'time', 'url', 'offset', 'available_at', 'last_book_date', 'user')
+
+    def __init__(self, booking: Booking) -> None:
+        """
+        :param booking: The booking to copy together with its user
+        """
+        super().__init__(booking, user=_UserSnapshot(booking.user))
+
+
+def _load_booking(booking_id: int) -> _BookingSnapshot:
+    """
+    Load a snapshot of the booking in a short-lived session
+    :param booking_id: The id of the booking
+    :return: The snapshot or None if the booking doesn't exist
+    """
+    try:
+        booking = db.session.get(Booking, booking_id)
+        return _BookingSnapshot(booking) if booking else None
+    finally:
+        db.session.remove()
+
+
+def _update(model, _id: int, **values) -> None:
+    """
+    Update the given fields of a row in a short-lived session
+    :param model: The model to update
+    :param _id: The id of the row
+    :param values: The new values by field
+    """
+    try:
+        db.session.query(model).filter_by(id=_id).update(values)
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+def _to_naive_madrid(value: datetime) -> datetime:
+    """
+    Convert a timezone aware datetime to the naive Madrid time stored in the database
+    :param value: The datetime to convert
+    """
+    return value.astimezone(_MADRID_TZ).replace(tzinfo=None) if value else None
+
+
+def _new_loop_id() -> int:
+    return next(__LOOP_IDS)
 
 
-class Booker(StoppableThread):
+def _save_schedule(booker, booking_id: int, loop_id: int, class_datetime: datetime, waiter) -> None:
+    """
+    Store when the booking loop will fire next, so it can be queried without asking the threads.
+    Nothing is stored if the loop has been stopped or if a newer loop of the booking has stored
+    its schedule already
+    :param booker: The booking loop
+    :param booking_id: The id of the booking
+    :param loop_id: The id of the booking loop
+    :param class_datetime: The date and time of the class being booked
+    :param waiter: The waiter the loop is about to wait on
+    """
+    if __CURRENT_THREADS.get(booking_id) is not booker:
+        return
+    table = Schedule.__table__
+    values = {"class_datetime": _to_naive_madrid(class_datetime), "fire_at": _to_naive_madrid(waiter.get_deadline()),
+              "waiter": waiter.kind, "loop_id": loop_id, "updated_at": get_clock().now()}
+    try:
+        db.session.execute(sqlite_insert(table).values(booking_id=booking_id, **values)
+                           .on_conflict_do_update(index_elements=[table.c.booking_id], set_=values,
+                                                  where=func.coalesce(table.c.loop_id, 0) <= loop_id))
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+def _delete_schedule(booking_id: int, loop_id: int) -> None:
+    """
+    Remove the schedule of a booking loop which is not running anymore. The schedule of a newer
+    loop of the booking is kept
+    :param booking_id: The id of the booking
+    :param loop_id: The id of the booking loop
+    """
+    try:
+        db.session.query(Schedule).filter_by(booking_id=booking_id, loop_id=loop_id).delete()
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+def get_upcoming_schedules(until: datetime) -> list:
+    """
+    Get the schedules of the booking loops firing up to the given datetime, soonest first
+    :param until: The maximum fire datetime
+    :return: The list of schedules
+    """
+    return db.session.query(Schedule).filter(Schedule.fire_at <= _to_naive_madrid(until)) \
+        .order_by(Schedule.fire_at).all()
+
+
+def _record_event(booking_id: int, message: str, owner) -> None:
+    """
+    Add an event to the booking in a short-lived session
+    :param booking_id: The id of the booking
+    :param message: The event message
+    :param owner: The cancellation token of the loop recording the event
+    """
+    event_date = get_clock().now()
+    try:
+        _add_event(Event(booking_id=booking_id, event=message, date=event_date))
+        db.session.commit()
+    finally:
+        db.session.remove()
+    update_booking_status(booking_id, owner, last_event=message, last_event_date=event_date)
+
+
+def _send_booking_email(booking: Booking, datetime_to_book: datetime, email, sent_emails: Counter) -> None:
+    """
+    Send an email about a booking attempt. The delivery key identifies the email by booking, class,
+    kind of email and number of times the loop already sent it, so a booker restarted after a crash
+    doesn't send the same email twice while repeated notifications of the same loop are still sent
+    :param booking: The booking the email is about
+    :param datetime_to_book: The datetime of the class being booked
+    :param email: The email to send
+    :param sent_emails: Number of emails sent by the loop by delivery key prefix. It's updated
+    """
+    class_date = datetime_to_book.date().isoformat() if datetime_to_book else None
+    key = f"{booking.id}:{class_date}:{email.__class__.__name__}:{email.subject}"
+    send_email(booking.user, email, delivery_key=f"{key}:{sent_emails[key]}")
+    sent_emails[key] += 1
+
+
+class _BookingBatch():
+
+    def __init__(self) -> None:
+        """
+        Classes of a user to be booked together for the same box and day
+        """
+        self.booking_datetimes = []
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+class _BookingBatcher():
+    """
+    Group the booking attempts of a user for the same box and day. The first booker sleeps the
+    anti-bot delay while the others join the batch, and then all the classes are booked with a
+    single LoadClass fetch. If the first booker is stopped meanwhile, another one takes its place
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def book(self, scraper: Scraper, url: str, datetime_to_book: datetime, delay: int,
+             cancellation: CancellationToken) -> bool:
+        """
+        Book the class, together with the rest of classes of the user for the same box and day
+        requested while waiting
+        :param scraper: The scraper of the user
+        :param url: The WodBuster URL
+        :param datetime_to_book: The date and time of the class
+        :param delay: The number of seconds to wait before booking
+        :param cancellation: The token cancelling the wait of the booker
+        :return: True if the class was booked
+        :raises: The same exceptions as Scraper.book
+        :raises OperationCancelled: If the token is cancelled while waiting
+        """
+        key = (scraper, url, datetime_to_book.date())
+        with self._lock:
+            batch = self._batches.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = _BookingBatch()
+                self._batches[key] = batch
+            batch.booking_datetimes.append(datetime_to_book)
+
+        if is_leader:
+            try:
+                _LOGGER.info("Sleeping for %s seconds", delay)
+                cancellation.sleep(delay)
+                with self._lock:
+                    del self._batches[key]
+                _LOGGER.info("Booking %s classes in a single batch", len(batch.booking_datetimes))
+                batch.results = scraper.book_many(url, batch.booking_datetimes)
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._lock:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+                batch.done.set()
+        else:
+            _LOGGER.info("Joining the booking batch for %s", datetime_to_book.strftime('%d/%m/%Y'))
+            while not get_clock().wait(batch.done, _BATCH_POLL_INTERVAL):
+                cancellation.raise_if_cancelled()
+
+        if batch.error:
+            raise batch.error
+
+        hour = datetime_to_book.strftime('%H:%M:%S')
+        if hour not in batch.results:
+            # The leader was stopped before booking. The batch is started again, so the first follower
+            # back becomes the new leader and sleeps the anti-bot delay before booking
+            _LOGGER.info("Booking batch for %s stopped before booking. Starting it again",
+                         datetime_to_book.strftime('%d/%m/%Y'))
+            return self.book(scraper, url, datetime_to_book, delay, cancellation)
+
+        result = batch.results[hour]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+_BOOKING_BATCHER = _BookingBatcher()
+
+
+class Booker(threading.Thread):
 
     def __init__(self, booking: Booking, app_context):
         """
         :param booking: The booking to run
         :param app_context: The Flask app context
         """
-        super(Booker, self).__init__()
+        super(Booker, self).__init__(daemon=True)
         self._booking = None
         self._booking_id = booking.id
         self._session = None
+        self._scraper_email = None
         self._app_context = app_context
+        self._cancellation = CancellationToken()
+        self._loop_id = _new_loop_id()
+        self._sent_emails = Counter()
         self.name = f"Booker {self._booking_id}"
+        # The cancellation token identifies this loop as the owner of the state of the booking
+        claim_booking_status(self._booking_id, self._cancellation)
+
+    def stop(self) -> None:
+        """
+        Stop the booking loop. Ongoing waits are interrupted and open event streams are closed
+        """
+        self._cancellation.cancel()
 
     def run(self) -> None:
         try:
             self._app_context.push()
-            self._booking = db.session.query(Booking).filter_by(id=self._booking_id).first()
+            set_log_context(booking_id=self._booking_id)
             errors = 0
             force_exit = False
             waiter = None
@@ -88,15 +367,28 @@ class Booker(StoppableThread):
             skip_current_week = False
             class_is_full_notification_sent = False
             while errors < _MAX_ERRORS and not force_exit:
+                # The booking is reloaded on each iteration so edits and previous updates are taken into account
+                self._booking = _load_booking(self._booking_id)
+                if not self._booking:
+                    _LOGGER.info("Booking %s no longer exists", self._booking_id)
+                    return
+                if self._scraper_email is None:
+                    # The scraper of the user is kept while this loop runs, however long it waits
+                    self._scraper_email = self._booking.user.email
+                    hold_scraper(self._scraper_email)
+                update_booking_status(self._booking_id, self._cancellation, user=self._booking.user.email,
+                                      url=self._booking.url, errors=errors)
+                set_log_context(box=self._booking.url)
+
                 try:
                     book_time = time(self._booking.time.hour, self._booking.time.minute, 0)
                     _datetime_to_book = _get_datetime_to_book(self._booking.last_book_date, self._booking.dow, book_time)
 
                     if waiter and datetime_to_book != _datetime_to_book:
-                        logging.info("Waiting for class %s is over.", datetime_to_book.strftime('%d/%m/%Y %H:%M'))
-                        event = Event(booking_id=self._booking.id,
-                                      event=EventMessage.CLASS_WAITING_OVER % (datetime_to_book.strftime('%d/%m/%Y'), _datetime_to_book.strftime('%d/%m/%Y')))
-                        _add_event(event)
+                        _LOGGER.info("Waiting for class %s is over.", datetime_to_book.strftime('%d/%m/%Y %H:%M'))
+                        _record_event(self._booking.id,
+                                      EventMessage.CLASS_WAITING_OVER % (datetime_to_book.strftime('%d/%m/%Y'), _datetime_to_book.strftime('%d/%m/%Y')),
+                                      self._cancellation)
                         class_is_full_notification_sent = False
                         waiter = None
                     elif datetime_to_book == _datetime_to_book and skip_current_week:
@@ -106,29 +398,43 @@ class Booker(StoppableThread):
                     datetime_to_book = _datetime_to_book
                     day_to_book = datetime_to_book.date()
 
-                    book_available_at = _MADRID_TZ.localize(
-                        datetime.combine(
-                            day_to_book - timedelta(days=self._booking.offset),
-                            self._booking.available_at))
+                    book_available_at = _get_book_available_at(day_to_book, self._booking.offset,
+                                                               self._booking.available_at)
 
                     waiter = waiter or _TimeWaiter(self._booking, EventMessage.WAIT_UNTIL_BOOKING_OPEN % (book_available_at.strftime('%d/%m/%Y a las %H:%M'),
                                                                                                           day_to_book.strftime('%d/%m/%Y')),
                                                    book_available_at)
 
                     if waiter:
-                        waiter.wait()
+                        _save_schedule(self, self._booking.id, self._loop_id, datetime_to_book, waiter)
+                        update_booking_status(self._booking.id, self._cancellation, state="waiting",
+                                              waiter=waiter.kind, deadline=waiter.get_deadline())
+                        set_log_context(phase=f"waiting_{waiter.kind}")
+                        waiter.wait(self._cancellation)
                     waiter = None
 
+                    # Classes prefetched for the day tell when they will be published without probing WodBuster
+                    classes = get_cached_classes(self._booking.url, day_to_book, _PREFETCH_MAX_AGE)
+                    publication_datetime = classes.get_available_at() if classes and not classes.is_loaded() else None
+                    if publication_datetime and publication_datetime > get_clock().now(_MADRID_TZ):
+                        raise BookingNotAvailable("Classes not published yet", publication_datetime)
+
                     # Refresh the scraper in case a new one is avaiable
                     scraper = get_scraper(self._booking.user.email, self._booking.user.cookie)
                     # generate a random number between 30 and 6o seconds to avoid being detected as a bot
                     sleep = random.randint(15, 60)
-                    logging.info("Sleeping for %s seconds", sleep)
-                    pause.seconds(sleep)
-                    scraper.book(self._booking.url, datetime_to_book)
-                    logging.info("Booking for user %s at %s completed successfully", self._booking.user.email, datetime_to_book.strftime('%d/%m/%Y %H:%M'))
-                    event = Event(booking_id=self._booking.id, event=EventMessage.BOOKING_COMPLETED % day_to_book.strftime('%d/%m/%Y'))
-                    _add_event(event)
+                    update_booking_status(self._booking.id, self._cancellation, state="booking", waiter=None,
+                                          deadline=None)
+                    set_log_context(phase="booking")
+                    try:
+                        _BOOKING_BATCHER.book(scraper, self._booking.url, datetime_to_book, sleep, self._cancellation)
+                    finally:
+                        update_booking_status(self._booking.id, self._cancellation,
+                                              last_attempt_latency=scraper.get_last_book_latency())
+                    _LOGGER.info("Booking for user %s at %s completed successfully", self._booking.user.email, datetime_to_book.strftime('%d/%m/%Y %H:%M'),
+                                 extra={"latency": scraper.get_last_book_latency()})
+                    _record_event(self._booking.id, EventMessage.BOOKING_COMPLETED % day_to_book.strftime('%d/%m/%Y'),
+                                  self._cancellation)
 
                     email = None
                     if errors > 0:
@@ -140,93 +446,101 @@ class Booker(StoppableThread):
                         class_is_full_notification_sent = False
 
                     email = email or SuccessEmail(self._booking, CLASS_BOOKED_MAIL_SUBJECT, CLASS_BOOKED_MAIL_BODY)
-                    send_email(self._booking.user, email)
+                    _send_booking_email(self._booking, datetime_to_book, email, self._sent_emails)
 
-                    self._booking.last_book_date = day_to_book
-                    self._booking.booked_at = datetime.now().replace(microsecond=0)
-                    self._booking.user.cookie = scraper.get_cookies()
+                    _update(Booking, self._booking.id, last_book_date=day_to_book,
+                            booked_at=get_clock().now().replace(microsecond=0))
+                    update_booking_status(self._booking.id, self._cancellation, state="booked", errors=errors)
+                    set_log_context(phase="booked")
+                    _update(User, self._booking.user.id, cookie=scraper.get_cookies())
                 except ClassNotFound as e:
-                    logging.warning("Class not found. Ignoring this week and attempting booking for next week %s", e)
+                    _LOGGER.warning("Class not found. Ignoring this week and attempting booking for next week %s", e)
                     skip_current_week = True
-                    event = Event(booking_id=self._booking.id, event=EventMessage.CLASS_NOT_FOUND % (datetime_to_book.strftime("%d/%m/%Y"), datetime_to_book.strftime("%H:%M")))
-                    _add_event(event)
-                    send_email(self._booking.user, ErrorEmail(self._booking, "Clase no encontrada", event.event))
+                    message = EventMessage.CLASS_NOT_FOUND % (datetime_to_book.strftime("%d/%m/%Y"), datetime_to_book.strftime("%H:%M"))
+                    _record_event(self._booking.id, message, self._cancellation)
+                    _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Clase no encontrada", message), self._sent_emails)
                 except BookingFailed as e:
-                    logging.warning("Class cannot be booked %s", e)
+                    _LOGGER.warning("Class cannot be booked %s", e)
                     skip_current_week = True
-                    event = Event(booking_id=self._booking.id, event=EventMessage.BOOKING_ERROR % (datetime_to_book.strftime("%d/%m/%Y"), str(e).rstrip(".")))
-                    _add_event(event)
-                    send_email(self._booking.user, ErrorEmail(self._booking, "Error en la reserva", event.event))
+                    message = EventMessage.BOOKING_ERROR % (datetime_to_book.strftime("%d/%m/%Y"), str(e).rstrip("."))
+                    _record_event(self._booking.id, message, self._cancellation)
+                    _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Error en la reserva", message), self._sent_emails)
                 except ClassIsFull:
-                    logging.info("Class is full. Setting wait for event to 'changedBooking'")
+                    _LOGGER.info("Class is full. Setting wait for a free seat on 'changedBooking'")
                     waiter = _EventWaiter(self._booking, EventMessage.CLASS_FULL % day_to_book.strftime('%d/%m/%Y'),
-                                          scraper, self._booking.url, day_to_book, ['changedBooking'], datetime_to_book)
+                                          scraper, self._booking.url, day_to_book, ['changedBooking'], datetime_to_book,
+                                          _FreeSeatFilter(scraper, self._booking.url, datetime_to_book))
                     if not class_is_full_notification_sent:
-                        send_email(self._booking.user, ErrorEmail(self._booking, "Clase llena", waiter.log_message))
+                        _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Clase llena", waiter.log_message), self._sent_emails)
                         class_is_full_notification_sent = True
                 except BookingNotAvailable as e:
                     if e.available_at:
-                        logging.info("Class is not bookeable yet. Setting wait for datetime to %s", e.available_at.strftime('%d/%m/%Y %H:%M'))
+                        _LOGGER.info("Class is not bookeable yet. Setting wait for datetime to %s", e.available_at.strftime('%d/%m/%Y %H:%M'))
                         waiter = _TimeWaiter(self._booking, EventMessage.WAIT_UNTIL_BOOKING_OPEN % (e.available_at.strftime('%d/%m/%Y a las %H:%M'),
                                                                                                     day_to_book.strftime('%d/%m/%Y')),
                                              e.available_at)
                     else:
-                        logging.info("Classes for %s are not loaded yet. Waiting for any type of event", day_to_book.strftime('%d/%m/%Y'))
+                        _LOGGER.info("Classes for %s are not loaded yet. Waiting for any type of event", day_to_book.strftime('%d/%m/%Y'))
                         waiter = _EventWaiter(self._booking, EventMessage.WAIT_CLASS_LOADED % day_to_book.strftime('%d/%m/%Y'),
                                               scraper, self._booking.url, day_to_book,
                                               ['changedPizarra', 'changedBooking'], datetime_to_book)
                     continue
                 except RequestException as e:
                     sleep_for = (errors + 1) * 60
-                    logging.warning("Request Exception: %s", e)
+                    _LOGGER.warning("Request Exception: %s", e)
                     waiter = _TimeWaiter(self._booking, EventMessage.UNEXPECTED_NETWORK_ERROR % sleep_for,
-                                            datetime.now(_MADRID_TZ) + timedelta(seconds=sleep_for))
+                                            get_clock().now(_MADRID_TZ) + timedelta(seconds=sleep_for))
                     if errors == 0:
-                        send_email(self._booking.user, ErrorEmail(self._booking, UNEXPECTED_ERROR_MAIL_SUBJECT,
-                                                                  UNEXPECTED_ERROR_MAIL_BODY))
+                        _send_booking_email(self._booking, datetime_to_book,
+                                            ErrorEmail(self._booking, UNEXPECTED_ERROR_MAIL_SUBJECT,
+                                                       UNEXPECTED_ERROR_MAIL_BODY), self._sent_emails)
                     errors += 1
                 except InvalidWodBusterResponse as e:
                     sleep_for = (errors + 1) * 60
-                    logging.warning("Invalid WodBuster response: %s", e)
+                    _LOGGER.warning("Invalid WodBuster response: %s", e)
                     waiter = _TimeWaiter(self._booking, EventMessage.UNEXPECTED_WODBUSTER_RESPONSE % sleep_for,
-                                         datetime.now(_MADRID_TZ) + timedelta(seconds=sleep_for))
+                                         get_clock().now(_MADRID_TZ) + timedelta(seconds=sleep_for))
                     if errors == 0:
-                        send_email(self._booking.user, ErrorEmail(self._booking, UNEXPECTED_ERROR_MAIL_SUBJECT,
-                                                                  UNEXPECTED_ERROR_MAIL_BODY))
+                        _send_booking_email(self._booking, datetime_to_book,
+                                            ErrorEmail(self._booking, UNEXPECTED_ERROR_MAIL_SUBJECT,
+                                                       UNEXPECTED_ERROR_MAIL_BODY), self._sent_emails)
                     errors += 1
                 except PasswordRequired:
                     force_exit = True
-                    logging.warning("Credentials for user %s are outdated. Aborting...", self._booking.user.email)
-                    self._booking.user.force_login = True
-                    event = Event(booking_id=self._booking.id, event=EventMessage.CREDENTIALS_EXPIRED)
-                    _add_event(event)
-                    send_email(self._booking.user, ErrorEmail(self._booking, "Credenciales caducadas", event.event))
+                    _LOGGER.warning("Credentials for user %s are outdated. Aborting...", self._booking.user.email)
+                    _update(User, self._booking.user.id, force_login=True)
+                    message = EventMessage.CREDENTIALS_EXPIRED
+                    _record_event(self._booking.id, message, self._cancellation)
+                    _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Credenciales caducadas", message), self._sent_emails)
                 except LoginError:
                     force_exit = True
-                    logging.warning("User %s cannot be logged in into WodBuster. Aborting...", self._booking.user.email)
-                    self._booking.user.force_login = True
-                    event = Event(booking_id=self._booking.id, event=EventMessage.LOGIN_FAILED)
-                    _add_event(event)
-                    send_email(self._booking.user, ErrorEmail(self._booking, "Login fallido", event.event))
+                    _LOGGER.warning("User %s cannot be logged in into WodBuster. Aborting...", self._booking.user.email)
+                    _update(User, self._booking.user.id, force_login=True)
+                    message = EventMessage.LOGIN_FAILED
+                    _record_event(self._booking.id, message, self._cancellation)
+                    _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Login fallido", message), self._sent_emails)
                 except InvalidBox:
                     force_exit = True
-                    logging.warning("User %s accessing to an invalid box detected. Aborting...", self._booking.user.email)
-                    event = Event(booking_id=self._booking.id, event=EventMessage.INVALID_BOX_URL)
-                    _add_event(event)
-                    send_email(self._booking.user, ErrorEmail(self._booking, "Box inválido", event.event))
-                finally:
-                    db.session.commit()
+                    _LOGGER.warning("User %s accessing to an invalid box detected. Aborting...", self._booking.user.email)
+                    message = EventMessage.INVALID_BOX_URL
+                    _record_event(self._booking.id, message, self._cancellation)
+                    _send_booking_email(self._booking, datetime_to_book, ErrorEmail(self._booking, "Box inválido", message), self._sent_emails)
 
             if errors >= _MAX_ERRORS:
-                logging.error("Exiting thread as maximum number of retries has been reached. Review logs for more information")
-                event = Event(booking_id=self._booking.id, event=EventMessage.TOO_MANY_ERRORS)
-                _add_event(event)
-                db.session.commit()
-            logging.info("Exiting thread...")
-        except _StopThreadException:
-            logging.info("Thread %s has been stopped", self._name)
+                _LOGGER.error("Exiting thread as maximum number of retries has been reached. Review logs for more information")
+                _record_event(self._booking.id, EventMessage.TOO_MANY_ERRORS, self._cancellation)
+            _LOGGER.info("Exiting thread...")
+        except OperationCancelled:
+            _LOGGER.info("Thread %s has been stopped", self._name)
         except Exception:
-            logging.exception("Unexpected error while booking. Aborting...")
+            _LOGGER.exception("Unexpected error while booking. Aborting...")
+        finally:
+            if self._scraper_email is not None:
+                release_scraper(self._scraper_email)
+            _delete_schedule(self._booking_id, self._loop_id)
+            remove_booking_status(self._booking_id, self._cancellation)
+            clear_log_context()
+            self._app_context.pop()
 
 
 class _Waiter(ABC):
@@ -241,15 +555,26 @@ class _Waiter(ABC):
         self.log_message = log_message
 
     @abstractmethod
-    def wait(self):
+    def wait(self, cancellation: CancellationToken):
         """
         Wait until the condition is met
+        :param cancellation: The token cancelling the wait
+        :raises OperationCancelled: If the token is cancelled while waiting
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_deadline(self) -> datetime:
+        """
+        Returns the datetime when the wait will be over at the latest
         """
         raise NotImplementedError()
 
 
 class _TimeWaiter(_Waiter):
 
+    kind = "time"
+
     def __init__(self, booking: Booking, log_message: str, wait_datetime: datetime) -> None:
         """
         Time Waiter construction
@@ -260,22 +585,27 @@ class _TimeWaiter(_Waiter):
         super().__init__(booking, log_message)
         self._wait_datetime = wait_datetime
 
-    def wait(self):
+    def wait(self, cancellation: CancellationToken):
         """
         Wait until the provided date is reached
+        :param cancellation: The token cancelling the wait
         """
-        if self._wait_datetime > datetime.now(_MADRID_TZ):
-            logging.info("Waiting until %s", self._wait_datetime.strftime('%d/%m/%Y %H:%M:%S'))
-            event = Event(booking_id=self.booking.id, event=self.log_message)
-            _add_event(event)
-            db.session.commit()
-            pause.until(self._wait_datetime)
+        if self._wait_datetime > get_clock().now(_MADRID_TZ):
+            _LOGGER.info("Waiting until %s", self._wait_datetime.strftime('%d/%m/%Y %H:%M:%S'))
+            _record_event(self.booking.id, self.log_message, cancellation)
+            cancellation.sleep_until(self._wait_datetime)
+
+    def get_deadline(self) -> datetime:
+        return self._wait_datetime
 
 
 class _EventWaiter(_Waiter):
 
+    kind = "event"
+
     def __init__(self, booking: Booking, log_message: str, scraper: Scraper, url: str,
-                 event_date: date, expected_events:list, max_datetime: datetime=None):
+                 event_date: date, expected_events:list, max_datetime: datetime=None,
+                 event_filter=None):
         """
         Event Waiter construction
         :param booking: The booking the waiter is related to
@@ -285,6 +615,7 @@ class _EventWaiter(_Waiter):
         :param date: The day associated with the occurrence of the event
         :param expected_events: A list with the expected events
         :param max_datetime: The maximum datetime to wait for
+        :param event_filter: Optional function deciding whether an expected event ends the wait
         """
         super().__init__(booking, log_message)
         self._scraper = scraper
@@ -292,16 +623,79 @@ class _EventWaiter(_Waiter):
         self._event_date = event_date
         self._expected_events = expected_events
         self._max_datetime = max_datetime
+        self._event_filter = event_filter
 
-    def wait(self):
+    def wait(self, cancellation: CancellationToken):
         """
         Wait until the event occurs
+        :param cancellation: The token cancelling the wait
         """
-        event = Event(booking_id=self.booking.id, event=self.log_message)
-        _add_event(event)
-        db.session.commit()
-        self._scraper.wait_until_event(self._url, self._event_date, self._expected_events,
-                                       self._max_datetime)
+        _record_event(self.booking.id, self.log_message, cancellation)
+        update_booking_status(self.booking.id, cancellation, sse_active=True)
+        try:
+            self._scraper.wait_until_event(self._url, self._event_date, self._expected_events,
+                                           self._max_datetime, self._event_filter, cancellation)
+        finally:
+            update_booking_status(self.booking.id, cancellation, sse_active=False)
+
+    def get_deadline(self) -> datetime:
+        return self._max_datetime
+
+
+class _FreeSeatFilter():
+
+    def __init__(self, scraper: Scraper, url: str, class_datetime: datetime) -> None:
+        """
+        Event filter letting through only the events received when the class has a free seat.
+        Events whose payload refers to other classes of the day are discarded without fetching
+        the seats
+        :param scraper: The scraper to use
+        :param url: The WodBuster URL
+        :param class_datetime: The date and time of the class
+        """
+        self._scraper = scraper
+        self._url = url
+        self._class_datetime = class_datetime
+
+    def __call__(self, record) -> bool:
+        if not self._concerns_class(record):
+            return False
+        free_seats = self._scraper.get_free_seats(self._url, self._class_datetime)
+        # A class that has disappeared also ends the wait, so the booking attempt reports it
+        return free_seats is None or free_seats > 0
+
+    def _concerns_class(self, record) -> bool:
+        """
+        Check whether an event may concern the class. The class ids and hours of the day found in the
+        payload tell which classes changed. When none is found, the event may concern any class
+        """
+        classes = get_cached_classes(self._url, self._class_datetime.date(), _CLASS_IDS_MAX_AGE)
+        if not classes:
+            return True
+        hours_by_class_id = classes.get_hours_by_class_id()
+        hours = {hour[:5] for hour in hours_by_class_id.values()}
+        references = _get_payload_references(record.get_data().get("arguments"))
+        class_hours = {hours_by_class_id[reference][:5] for reference in references if reference in hours_by_class_id}
+        class_hours.update(reference for reference in references if reference in hours)
+        return not class_hours or self._class_datetime.strftime('%H:%M') in class_hours
+
+
+def _get_payload_references(value) -> set:
+    """
+    Get the values of an event payload which may identify a class: numbers, as class ids, and hours
+    in HH:MM format
+    :param value: The arguments of the event
+    """
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return set().union(*(_get_payload_references(item) for item in value))
+    if isinstance(value, int) and not isinstance(value, bool):
+        return {str(value)}
+    if isinstance(value, str):
+        hour = _PAYLOAD_HOUR_REGEX.search(value)
+        return {value, hour.group(0)} if hour else {value}
+    return set()
 
 
 def _add_event(event: Event) -> None:
@@ -321,27 +715,98 @@ def start_booking_loop(booking: Booking) -> None:
     :param offset: The offset from today to book
     :param availabe_at: The time when the booking is available
     """
-    logging.info("Starting thread for booking %s", booking.id)
+    _LOGGER.info("Starting thread for booking %s", booking.id)
     booker = Booker(booking, app.app_context())
     __CURRENT_THREADS[booking.id] = booker
     booker.start()
 
+def start_booking_loops(bookings: list) -> None:
+    """
+    Start the booking loops of several bookings
+    :param bookings: The bookings to run
+    """
+    for booking in bookings:
+        start_booking_loop(booking)
+
+
 def stop_booking_loop(booking: Booking, log_pause: bool=False) -> None:
     """ 
     Stop the booking loop for a given booking 
     :param booking: The booking to stop
     :param log_pause: If True, a pause event is logged
     """
-    logging.info("Stopping thread for booking %s", booking)
-    if booking.id in __CURRENT_THREADS:
-        booker = __CURRENT_THREADS[booking.id]
-        booker.stop(_StopThreadException)
-        del __CURRENT_THREADS[booking.id]
+    stop_booking_loops([booking], {booking.id} if log_pause else None)
+
+
+def stop_booking_loops(bookings: list, paused_ids: set=None) -> None:
+    """
+    Stop the booking loops of several bookings. The loops are signalled without waiting for
+    them, so a loop finishing an ongoing request doesn't block the caller
+    :param bookings: The bookings to stop
+    :param paused_ids: The ids of the bookings whose stop is logged as a pause event
+    """
+    stopped_bookings = []
+    for booking in bookings:
+        _LOGGER.info("Stopping thread for booking %s", booking)
+        booker = __CURRENT_THREADS.pop(booking.id, None)
+        if booker:
+            booker.stop()
+            stopped_bookings.append(booking)
+
+    paused_bookings = [booking for booking in stopped_bookings if paused_ids and booking.id in paused_ids]
+    for booking in paused_bookings:
+        _add_event(Event(booking_id=booking.id, event=EventMessage.PAUSED))
+    if paused_bookings:
+        db.session.commit()
+
+def prefetch_classes_loop(app_context) -> None:
+    """
+    Periodically fetch the classes of the days whose bookings open in the next hours, so bookers
+    know the publication time of each day before attempting the booking
+    :param app_context: The Flask app context
+    """
+    app_context.push()
+    set_log_context(phase="prefetch")
+    with app_context:
+        while True:
+            try:
+                _prefetch_classes()
+            except Exception:
+                _LOGGER.exception("Unexpected error while prefetching classes")
+            finally:
+                db.session.rollback()
+            get_clock().sleep(_PREFETCH_INTERVAL)
+
+
+def _prefetch_classes() -> None:
+    """
+    Fetch once the classes of every box and day whose bookings open within the prefetch horizon.
+    Requests are spaced so the prefetcher never competes with the bookers
+    """
+    now = get_clock().now(_MADRID_TZ)
+    users_by_day = {}
+    for booking in db.session.query(Booking).filter_by(is_active=True).all():
+        book_time = time(booking.time.hour, booking.time.minute, 0)
+        day_to_book = _get_datetime_to_book(booking.last_book_date, booking.dow, book_time).date()
+        book_available_at = _get_book_available_at(day_to_book, booking.offset, booking.available_at)
+        if now <= book_available_at <= now + _PREFETCH_HORIZON:
+            users_by_day.setdefault((booking.url, day_to_book), booking.user)
+
+    for (url, day), user in users_by_day.items():
+        classes = get_cached_classes(url, day, _PREFETCH_MAX_AGE)
+        if classes and classes.is_loaded():
+            continue
+
+        try:
+            scraper = get_scraper(user.email, user.cookie)
+            scraper.login()
+            classes = scraper.get_classes(url, day)
+            _LOGGER.info("Classes for %s at %s prefetched. Published: %s", day.strftime('%d/%m/%Y'), url,
+                         classes.is_loaded() or classes.get_available_at())
+        except (RequestException, InvalidWodBusterResponse, LoginError, PasswordRequired, InvalidBox) as e:
+            _LOGGER.warning("Classes for %s at %s cannot be prefetched: %s", day.strftime('%d/%m/%Y'), url, e)
+        get_clock().sleep(_PREFETCH_REQUEST_INTERVAL)
 
-        if log_pause:
-            event = Event(booking_id=booking.id, event=EventMessage.PAUSED)
-            _add_event(event)
-            db.session.commit()
 
 def is_booking_running(booking: Booking) -> bool:
     """
@@ -0,0 +1,78 @@
+from datetime import datetime
+from contextlib import contextmanager
+import threading
+from .exceptions import OperationCancelled
+from .clock import get_clock
+
+
+class CancellationToken():
+    """
+    Cooperative cancellation for long running operations. Waits done through the token return
+    as soon as it's cancelled, and blocking resources registered in it (e.g. streaming responses)
+    are closed on cancellation so the threads using them are released immediately
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self) -> None:
+        """
+        Cancel the token, running the registered callbacks
+        """
+        with self._lock:
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self) -> bool:
+        """
+        Returns True if the token has been cancelled
+        """
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        """
+        :raises OperationCancelled: If the token has been cancelled
+        """
+        if self._event.is_set():
+            raise OperationCancelled()
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Sleep for the given number of seconds
+        :param seconds: The number of seconds to sleep
+        :raises OperationCancelled: If the token is cancelled while sleeping
+        """
+        if get_clock().wait(self._event, seconds):
+            raise OperationCancelled()
+
+    def sleep_until(self, until: datetime) -> None:
+        """
+        Sleep until the given datetime is reached. The clock is checked again at least once a minute
+        so system clock adjustments are taken into account
+        :param until: A timezone aware datetime
+        :raises OperationCancelled: If the token is cancelled while sleeping
+        """
+        remaining_seconds = (until - get_clock().now(until.tzinfo)).total_seconds()
+        while remaining_seconds > 0:
+            self.sleep(min(remaining_seconds, 60))
+            remaining_seconds = (until - get_clock().now(until.tzinfo)).total_seconds()
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """
+        Run the given callback if the token is cancelled while in the context
+        :param callback: Function with no arguments, usually closing a blocking resource
+        :raises OperationCancelled: If the token is already cancelled when entering the context
+        """
+        with self._lock:
+            self.raise_if_cancelled()
+            self._callbacks.append(callback)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._callbacks.remove(callback)
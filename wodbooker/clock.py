@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+import time
+import threading
+import pytz
+
+_UTC_TZ = pytz.timezone('UTC')
+# Real time slice used by simulated waits to notice events set while waiting
+_SIMULATED_POLL_INTERVAL = 0.01
+
+
+class Clock():
+    """
+    Wall clock used by the booking engine. Every read of the current time and every wait of the
+    engine goes through the clock, so it can be replaced by a simulated one
+    """
+
+    def now(self, tz=None) -> datetime:
+        """
+        Returns the current datetime
+        :param tz: The timezone of the returned datetime. If None, a naive local datetime is returned
+        """
+        return datetime.now(tz)
+
+    def monotonic(self) -> float:
+        """
+        Returns the value in seconds of a clock that cannot go backwards
+        """
+        return time.monotonic()
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        """
+        Wait until the event is set or the given number of seconds elapse
+        :param event: The event to wait for
+        :param seconds: The maximum number of seconds to wait
+        :return: True if the event is set
+        """
+        return event.wait(max(0, seconds))
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Sleep for the given number of seconds
+        :param seconds: The number of seconds to sleep
+        """
+        self.wait(threading.Event(), seconds)
+
+
+class SimulatedClock(Clock):
+    """
+    Virtual clock whose time only moves when it is advanced, so weeks of booking loops can be run
+    in a few seconds. Waits block until the clock is advanced beyond their deadline
+    """
+
+    def __init__(self, start: datetime):
+        """
+        :param start: The timezone aware datetime the clock starts at
+        """
+        self._now = start.astimezone(_UTC_TZ)
+        self._elapsed = 0.0
+        self._condition = threading.Condition()
+        self._waits = []
+
+    def now(self, tz=None) -> datetime:
+        with self._condition:
+            now = self._now
+        return tz.normalize(now.astimezone(tz)) if tz else now.astimezone().replace(tzinfo=None)
+
+    def monotonic(self) -> float:
+        with self._condition:
+            return self._elapsed
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        with self._condition:
+            wait = (self._elapsed + max(0, seconds), event)
+            self._waits.append(wait)
+            self._condition.notify_all()
+            try:
+                while not event.is_set() and self._elapsed < wait[0]:
+                    self._condition.wait(_SIMULATED_POLL_INTERVAL)
+            finally:
+                self._waits.remove(wait)
+            return event.is_set()
+
+    def advance(self, seconds: float) -> None:
+        """
+        Move the clock forward, releasing the waits whose deadline is reached
+        :param seconds: The number of seconds to advance
+        """
+        with self._condition:
+            self._elapsed += seconds
+            self._now += timedelta(seconds=seconds)
+            self._condition.notify_all()
+
+    def advance_to(self, until: datetime) -> None:
+        """
+        Move the clock forward to the given datetime. Nothing is done if it is already in the past
+        :param until: A timezone aware datetime
+        """
+        with self._condition:
+            seconds = (until - self._now).total_seconds()
+        if seconds > 0:
+            self.advance(seconds)
+
+    def advance_to_next_deadline(self, waiting: int, until: datetime, timeout: float) -> bool:
+        """
+        Block until the given number of threads are waiting on the clock, and then move the clock
+        forward to the earliest deadline of their waits. Waits whose event is set or whose deadline
+        is reached don't count, as their threads are about to go on
+        :param waiting: The number of threads which must be waiting
+        :param until: A timezone aware datetime the clock never goes beyond
+        :param timeout: The maximum number of real seconds to block
+        :return: False if the threads were not waiting within the timeout or the clock reached until
+        """
+        blocked_until = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                deadlines = [deadline for deadline, event in self._waits
+                             if not event.is_set() and deadline > self._elapsed]
+                if len(deadlines) >= waiting:
+                    break
+                if time.monotonic() >= blocked_until:
+                    return False
+                self._condition.wait(_SIMULATED_POLL_INTERVAL)
+            seconds = min(min(deadlines, default=0) - self._elapsed, (until - self._now).total_seconds())
+            if seconds > 0:
+                self.advance(seconds)
+            return self._now < until
+
+
+_CLOCK = Clock()
+
+
+def get_clock() -> Clock:
+    """
+    Returns the clock used by the booking engine
+    """
+    return _CLOCK
+
+
+def set_clock(clock: Clock) -> None:
+    """
+    Replace the clock used by the booking engine, e.g. by a simulated one
+    :param clock: The new clock
+    """
+    global _CLOCK
+    _CLOCK = clock
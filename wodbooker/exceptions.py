@@ -46,3 +46,9 @@ class BookingFailed(Exception):
     """
     Raises when the booking fails
     """
+
+class OperationCancelled(BaseException):
+    """
+    Raises when an ongoing operation is cancelled. As with SystemExit, it doesn't inherit from
+    Exception so generic error handlers don't swallow it
+    """
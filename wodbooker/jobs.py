@@ -0,0 +1,104 @@
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from .clock import get_clock
+
+_MAX_WORKERS = 8
+_JOB_TTL = 60 * 10
+
+
+class _BackgroundJobs():
+    """
+    Executor of the slow network operations requested from the webapp, such as logging into
+    WodBuster. Web requests submit a job and poll for its result, so web workers are never
+    blocked waiting for WodBuster
+    """
+
+    def __init__(self, max_workers: int, ttl: int):
+        """
+        :param max_workers: The maximum number of jobs running at the same time
+        :param ttl: The number of seconds a job is kept once submitted
+        """
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._ids_by_key = {}
+
+    def submit(self, fn, *args, key=None) -> str:
+        """
+        Run the given function in the background
+        :param fn: The function to run
+        :param args: The arguments of the function
+        :param key: If provided, the id of the pending job with the same key is returned instead of
+        submitting a new job
+        :return: The id of the job
+        """
+        with self._lock:
+            self._purge()
+            job_id = self._ids_by_key.get(key) if key is not None else None
+            if job_id in self._jobs and not self._jobs[job_id][1].done():
+                return job_id
+
+            job_id = secrets.token_urlsafe(16)
+            self._jobs[job_id] = (get_clock().monotonic(), self._executor.submit(fn, *args), key)
+            if key is not None:
+                self._ids_by_key[key] = job_id
+            return job_id
+
+    def get(self, job_id: str) -> Future:
+        """
+        Returns the future of a job or None if the job doesn't exist or has expired
+        :param job_id: The id of the job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job[1] if job else None
+
+    def forget(self, job_id: str) -> None:
+        """
+        Discard a job whose result has been consumed
+        :param job_id: The id of the job
+        """
+        with self._lock:
+            self._remove(job_id)
+
+    def _purge(self):
+        expiration = get_clock().monotonic() - self._ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job[0] < expiration]:
+            self._remove(job_id)
+
+    def _remove(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job and self._ids_by_key.get(job[2]) == job_id:
+            del self._ids_by_key[job[2]]
+
+
+_JOBS = _BackgroundJobs(_MAX_WORKERS, _JOB_TTL)
+
+
+def submit_job(fn, *args, key=None) -> str:
+    """
+    Run the given function in the background
+    :param fn: The function to run
+    :param args: The arguments of the function
+    :param key: If provided, a pending job with the same key is reused
+    :return: The id of the job, used to poll for its result
+    """
+    return _JOBS.submit(fn, *args, key=key)
+
+
+def get_job(job_id: str) -> Future:
+    """
+    Returns the future of a job or None if the job doesn't exist or has expired
+    :param job_id: The id of the job
+    """
+    return _JOBS.get(job_id)
+
+
+def forget_job(job_id: str) -> None:
+    """
+    Discard a job whose result has been consumed
+    :param job_id: The id of the job
+    """
+    _JOBS.forget(job_id)
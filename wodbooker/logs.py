@@ -0,0 +1,161 @@
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+_QUEUE_SIZE = 10000
+_TEXT_FORMAT = '%(asctime)s - %(threadName)s - %(message)s'
+# Structured fields added to the records, either from the thread context or from the extra argument
+_FIELDS = ('booking_id', 'box', 'phase', 'latency')
+
+_context = threading.local()
+
+
+def set_log_context(**fields) -> None:
+    """
+    Set structured fields added to every record logged by the current thread
+    :param fields: The fields to set. A None value removes the field
+    """
+    context = getattr(_context, 'fields', {})
+    context.update(fields)
+    _context.fields = {name: value for name, value in context.items() if value is not None}
+
+
+def clear_log_context() -> None:
+    """
+    Remove the structured fields of the current thread
+    """
+    _context.fields = {}
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Add the fields of the thread context to the records. Run in the thread logging the record
+    """
+
+    def filter(self, record):
+        for name, value in getattr(_context, 'fields', {}).items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler which drops records when the queue is full instead of blocking the thread logging
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        # Handlers emit under their own lock, so the counter needs no other synchronization
+        try:
+            if self.dropped:
+                self._report_dropped()
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _report_dropped(self):
+        """
+        Log the number of records dropped since the last report, once the queue has room again
+        :raises queue.Full: If the queue is still full
+        """
+        record = logging.makeLogRecord({"name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                                        "msg": f"{self.dropped} log records dropped because the queue was full"})
+        self.queue.put_nowait(record)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The message and the traceback are rendered by the thread logging the record, but kept
+        # apart so formatters can place the structured fields
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _TextFormatter(logging.Formatter):
+    """
+    The classic text format followed by the structured fields of the record
+    """
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = " ".join(f"{name}={getattr(record, name)}" for name in _FIELDS if hasattr(record, name))
+        return f"{message} [{fields}]" if fields else message
+
+
+class _JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, so logs can be analysed by machines
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update({name: getattr(record, name) for name in _FIELDS if hasattr(record, name)})
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(log_format: str=None, levels: str=None) -> None:
+    """
+    Configure a non-blocking logging pipeline. Records are put into a bounded queue by the threads
+    logging them and written to stderr by a background listener
+    :param log_format: 'json' to write one JSON object per record, otherwise text is written
+    :param levels: Comma separated per-component levels, e.g. 'wodbooker.scraper=WARNING,wodbooker.booker=DEBUG'
+    """
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(_JsonFormatter() if log_format == 'json' else _TextFormatter(_TEXT_FORMAT))
+
+    log_queue = queue.Queue(_QUEUE_SIZE)
+    queue_handler = _DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+
+    invalid_levels = []
+    for component_level in filter(None, (levels or '').split(',')):
+        component, _, level = component_level.partition('=')
+        component, level = component.strip(), level.strip().upper()
+        if not component or not isinstance(logging.getLevelName(level), int):
+            invalid_levels.append(component_level)
+            continue
+        logging.getLogger(component).setLevel(level)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener, queue_handler)
+
+    for component_level in invalid_levels:
+        logging.getLogger(__name__).warning("Ignoring invalid log level '%s'. Expected component=LEVEL",
+                                            component_level)
+
+
+def _stop_listener(listener, queue_handler):
+    """
+    Write the pending records and report the records dropped since the last report
+    """
+    listener.stop()
+    if queue_handler.dropped:
+        sys.stderr.write(f"{queue_handler.dropped} log records dropped because the queue was full\n")
@@ -1,16 +1,41 @@
+import uuid
 import logging
 import string
+import threading
+from collections import deque
 from enum import Enum
+from datetime import timedelta
 from abc import abstractmethod, ABC
-from queue import Queue
 import boto3
-from botocore.exceptions import ClientError, EndpointConnectionError
-from .models import User, Booking
+from botocore.exceptions import ClientError, BotoCoreError
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from .models import User, Booking, OutgoingEmail, db
 from .constants import DAYS_OF_WEEK
+from .clock import get_clock
+
+_LOGGER = logging.getLogger(__name__)
 
 client = boto3.client('ses',region_name="eu-west-1")
 
-_queue = Queue()
+# Pending emails are kept in the database. Only a batch of them is loaded in memory at a time
+_BATCH_SIZE = 20
+_MAX_ATTEMPTS = 8
+_RETRY_DELAY = 60
+_MAX_RETRY_DELAY = 60 * 60
+_IDLE_WAIT = 60
+_PURGE_INTERVAL = 60 * 60
+# Delivered emails are kept for a while so their delivery keys are not reused
+_RETENTION = timedelta(days=7)
+
+# Attempts to write to the queue while the database is locked, waiting longer between attempts
+_WRITE_ATTEMPTS = 3
+_WRITE_RETRY_DELAY = 0.5
+_MAX_UNSAVED_EMAILS = 1000
+
+_new_email = threading.Event()
+# Emails which couldn't be stored in the database yet
+_unsaved_emails = deque(maxlen=_MAX_UNSAVED_EMAILS)
 
 _SENDER = "WodBooker <wodbooker@aitormagan.es>"
 _CHARSET = "UTF-8"
@@ -34,6 +59,15 @@ class EmailPermissions(Enum):
     SUCCESS = "mail_permission_success"
 
 
+class _DeliveryStatus(Enum):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    # The process stopped while sending, so the email may have been delivered
+    INTERRUPTED = "interrupted"
+
+
 class Email(ABC):
     """
     Email templates
@@ -145,62 +179,237 @@ class SuccessAfterErrorEmail(SuccessEmail):
         return EmailPermissions.FAILURE
 
 
-def send_email(user: User, email: Email):
+def send_email(user: User, email: Email, delivery_key: str=None):
     """
-    Send an email asynchronously
+    Send an email asynchronously. The email is stored in the database before returning, so it
+    survives restarts and SES outages
     :param user: The user to send the email to
     :param email: The mail to be sent
+    :param delivery_key: Unique key of the email. An email whose key has already been queued is ignored.
+    If not provided, a random key is used
     """
     to = user.email
     mail_allowed = getattr(user, email.required_permission().value, False)
     if mail_allowed:
-        _queue.put((to, email))
+        _enqueue_email(to, email, delivery_key or uuid.uuid4().hex)
     else:
-        logging.info("Email to '%s' not scheduled to be sent because of permissions", to)
+        _LOGGER.info("Email to '%s' not scheduled to be sent because of permissions", to)
 
 
-def _send_email(to: str, email: Email):
+def _enqueue_email(to: str, email: Email, delivery_key: str):
     """
-    Send an email using Amazon SES
+    Store an email to be sent by the mailer thread
     :param to: The email to send the email to
     :param email: The mail to be sent
+    :param delivery_key: Unique key of the email
     """
-
+    values = {"delivery_key": delivery_key, "to": to, "subject": email.get_subject(), "html": email.get_html(),
+              "text": email.get_plain_body()}
     try:
-        client.send_email(
-            Destination={
-                'ToAddresses': [
-                    to,
-                ],
-            },
-            Message={
-                'Body': {
-                    'Html': {
-                        'Charset': _CHARSET,
-                        'Data': email.get_html(),
-                    },
-                    'Text': {
-                        'Charset': _CHARSET,
-                        'Data': email.get_plain_body(),
-                    },
+        if not _insert_email(values):
+            _LOGGER.info("Email with delivery key %s already queued", delivery_key)
+            return
+    except SQLAlchemyError:
+        # The mailer thread stores it later, as long as the process doesn't stop meanwhile
+        _LOGGER.exception("Error queueing email '%s' to %s. Keeping it in memory", values["subject"], to)
+        if len(_unsaved_emails) == _unsaved_emails.maxlen:
+            dropped = _unsaved_emails[0]
+            _LOGGER.error("Too many emails kept in memory. Email '%s' to %s with delivery key %s is dropped",
+                          dropped["subject"], dropped["to"], dropped["delivery_key"])
+        _unsaved_emails.append(values)
+    _new_email.set()
+
+
+def _insert_email(values: dict) -> bool:
+    """
+    Store a pending email, retrying while the database is locked by other threads
+    :param values: The delivery key, recipient, subject, HTML and plain body of the email
+    :return: False if an email with the same delivery key was already stored
+    :raises SQLAlchemyError: If the email cannot be stored
+    """
+    now = get_clock().now()
+    result = _execute(OutgoingEmail.__table__.insert().prefix_with("OR IGNORE").values(
+        status=_DeliveryStatus.PENDING.value, attempts=0, next_attempt_at=now, created_at=now, **values))
+    return result.rowcount > 0
+
+
+def _execute(statement):
+    """
+    Execute a statement in its own transaction, retrying while the database is locked by other threads
+    :param statement: The statement to execute
+    :return: The result of the statement
+    :raises SQLAlchemyError: If the statement fails
+    """
+    for attempt in range(1, _WRITE_ATTEMPTS + 1):
+        try:
+            with db.engine.begin() as conn:
+                return conn.execute(statement)
+        except OperationalError as e:
+            if attempt == _WRITE_ATTEMPTS or "locked" not in str(e.orig):
+                raise
+            _LOGGER.warning("Database locked while updating the email queue. Retrying...")
+            get_clock().sleep(_WRITE_RETRY_DELAY * attempt)
+
+
+def _store_unsaved_emails() -> None:
+    """
+    Store the emails which couldn't be stored when they were sent
+    :raises SQLAlchemyError: If an email cannot be stored. It's kept in memory
+    """
+    while _unsaved_emails:
+        values = _unsaved_emails[0]
+        _insert_email(values)
+        _unsaved_emails.popleft()
+
+
+def _send_email(to: str, subject: str, html: str, text: str):
+    """
+    Send an email using Amazon SES
+    :param to: The email to send the email to
+    :param subject: The mail subject
+    :param html: The mail HTML
+    :param text: The mail plain body
+    :raises ClientError: If SES rejects the email
+    :raises BotoCoreError: If SES cannot be reached
+    """
+    client.send_email(
+        Destination={
+            'ToAddresses': [
+                to,
+            ],
+        },
+        Message={
+            'Body': {
+                'Html': {
+                    'Charset': _CHARSET,
+                    'Data': html,
                 },
-                'Subject': {
+                'Text': {
                     'Charset': _CHARSET,
-                    'Data': email.get_subject(),
+                    'Data': text,
                 },
             },
-            Source=_SENDER,
-        )
-        logging.info("Email '%s' sent to %s successfully", email.get_subject(), to)
-    except (ClientError, EndpointConnectionError):
-        logging.exception("Error sending email")
+            'Subject': {
+                'Charset': _CHARSET,
+                'Data': subject,
+            },
+        },
+        Source=_SENDER,
+    )
+
+
+def _set_status(email_id: int, from_status: _DeliveryStatus, to_status: _DeliveryStatus, **values) -> bool:
+    """
+    Move an email from one status to another
+    :param email_id: The id of the email
+    :param from_status: The status the email must be in
+    :param to_status: The new status
+    :param values: Other columns to update
+    :return: False if the email was not in the expected status
+    """
+    table = OutgoingEmail.__table__
+    result = _execute(update(table).where(table.c.id == email_id, table.c.status == from_status.value)
+                      .values(status=to_status.value, **values))
+    return result.rowcount > 0
+
+
+def _deliver(email) -> None:
+    """
+    Send a pending email, retrying it later with an exponential backoff if it cannot be sent.
+    The email is marked as being sent before calling SES, so an email whose delivery is
+    interrupted by a crash is never sent twice
+    :param email: The row of the pending email
+    """
+    attempts = email["attempts"] + 1
+    if not _set_status(email["id"], _DeliveryStatus.PENDING, _DeliveryStatus.SENDING, attempts=attempts):
+        return
+
+    try:
+        _send_email(email["to"], email["subject"], email["html"], email["text"])
+    except (ClientError, BotoCoreError):
+        if attempts >= _MAX_ATTEMPTS:
+            _LOGGER.exception("Error sending email '%s' to %s. Giving up after %d attempts",
+                              email["subject"], email["to"], attempts)
+            _set_status(email["id"], _DeliveryStatus.SENDING, _DeliveryStatus.FAILED)
+        else:
+            delay = min(_RETRY_DELAY * 2 ** (attempts - 1), _MAX_RETRY_DELAY)
+            _LOGGER.exception("Error sending email '%s' to %s. Retrying in %d seconds",
+                              email["subject"], email["to"], delay)
+            _set_status(email["id"], _DeliveryStatus.SENDING, _DeliveryStatus.PENDING,
+                        next_attempt_at=get_clock().now() + timedelta(seconds=delay))
+        return
+
+    _set_status(email["id"], _DeliveryStatus.SENDING, _DeliveryStatus.SENT, sent_at=get_clock().now())
+    _LOGGER.info("Email '%s' sent to %s successfully", email["subject"], email["to"])
+
+
+def _process_pending_emails() -> float:
+    """
+    Send a batch of the pending emails whose time has come
+    :return: The number of seconds until the next email is due
+    """
+    table = OutgoingEmail.__table__
+    pending = table.c.status == _DeliveryStatus.PENDING.value
+    with db.engine.connect() as conn:
+        emails = conn.execute(select(table).where(pending, table.c.next_attempt_at <= get_clock().now())
+                              .order_by(table.c.id).limit(_BATCH_SIZE)).mappings().all()
+
+    for email in emails:
+        _deliver(email)
+
+    if len(emails) == _BATCH_SIZE:
+        return 0
+
+    with db.engine.connect() as conn:
+        next_attempt_at = conn.execute(select(func.min(table.c.next_attempt_at)).where(pending)).scalar()
+    if next_attempt_at is None:
+        return _IDLE_WAIT
+    return min(max((next_attempt_at - get_clock().now()).total_seconds(), 0), _IDLE_WAIT)
+
+
+def _recover_interrupted_emails() -> None:
+    """
+    Mark the emails being sent when the process stopped. They are not sent again as SES may have
+    delivered them already
+    """
+    table = OutgoingEmail.__table__
+    with db.engine.begin() as conn:
+        result = conn.execute(update(table).where(table.c.status == _DeliveryStatus.SENDING.value)
+                              .values(status=_DeliveryStatus.INTERRUPTED.value))
+    if result.rowcount:
+        _LOGGER.warning("%d emails were being sent when the mailer stopped. They won't be sent again",
+                        result.rowcount)
+
+
+def _purge_emails() -> None:
+    """
+    Remove the delivered and discarded emails older than the retention period
+    """
+    table = OutgoingEmail.__table__
+    with db.engine.begin() as conn:
+        conn.execute(delete(table).where(table.c.status != _DeliveryStatus.PENDING.value,
+                                         table.c.status != _DeliveryStatus.SENDING.value,
+                                         table.c.created_at < get_clock().now() - _RETENTION))
 
 
-def process_maling_queue():
+def process_maling_queue(app_context):
     """
-    Process the email queue
+    Process the email queue. Pending emails left by a previous run are sent at once
+    :param app_context: The Flask app context
     """
-    while True:
-        user, email = _queue.get()
-        _send_email(user, email)
-        _queue.task_done()
+    app_context.push()
+    with app_context:
+        _recover_interrupted_emails()
+        last_purge = None
+        while True:
+            _new_email.clear()
+            try:
+                _store_unsaved_emails()
+                wait = _process_pending_emails()
+                if last_purge is None or get_clock().monotonic() - last_purge > _PURGE_INTERVAL:
+                    _purge_emails()
+                    last_purge = get_clock().monotonic()
+            except SQLAlchemyError:
+                _LOGGER.exception("Error processing the email queue")
+                wait = _IDLE_WAIT
+            get_clock().wait(_new_email, wait)
@@ -18,9 +18,16 @@ class Booking(db.Model):
     offset = db.Column(db.Integer)
     events = db.relationship('Event', backref='booking', lazy=True, cascade="all, delete-orphan")
     is_active = db.Column(db.Boolean, default=True)
+    schedule = db.relationship('Schedule', backref='booking', uselist=False, cascade="all, delete-orphan")
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
 
 class Event(db.Model):
+    __table_args__ = (
+        db.Index('ix_event_booking_id_date_id', 'booking_id', 'date', 'id'),
+        db.Index('ix_event_date_id', 'date', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))
     date = db.Column(db.DateTime, default=datetime.now)
@@ -30,6 +37,40 @@ class Event(db.Model):
         return f"{self.date.strftime('%d/%m/%Y %H:%M')}: {self.event}"
 
 
+class Schedule(db.Model):
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), primary_key=True)
+    class_datetime = db.Column(db.DateTime)
+    fire_at = db.Column(db.DateTime, index=True)
+    waiter = db.Column(db.String(16))
+    loop_id = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class Box(db.Model):
+    url = db.Column(db.String(128), primary_key=True)
+    name = db.Column(db.String(128))
+    sse_server = db.Column(db.String(256))
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class OutgoingEmail(db.Model):
+    __table_args__ = (
+        db.Index('ix_outgoing_email_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    delivery_key = db.Column(db.String(256), unique=True)
+    to = db.Column(db.String(120))
+    subject = db.Column(db.String(256))
+    html = db.Column(db.Text)
+    text = db.Column(db.Text)
+    status = db.Column(db.String(16))
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True)
@@ -37,6 +78,7 @@ class User(db.Model):
     force_login = db.Column(db.Boolean, default=False)
     mail_permission_success = db.Column(db.Boolean, default=True)
     mail_permission_failure = db.Column(db.Boolean, default=True)
+    box_url = db.Column(db.String(128))
 
     # Flask-Login integration
     # NOTE: is_authenticated, is_active, and is_anonymous
@@ -0,0 +1,176 @@
+import io
+import gzip
+import json
+import time
+import base64
+import threading
+from collections import defaultdict, deque
+import requests
+from requests.adapters import HTTPAdapter, BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+_REDACTED_HEADERS = ('set-cookie', 'cookie', 'authorization')
+# Requests to these paths carry credentials, so their bodies are never recorded
+_REDACTED_BODY_PATHS = ('/account/',)
+
+
+def _encode(content) -> str:
+    if content is None:
+        return None
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return base64.b64encode(content).decode('ascii')
+
+
+def _decode(content: str) -> bytes:
+    return base64.b64decode(content) if content else b''
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter recording every request/response pair sent through it into a gzipped JSON
+    lines file. Streamed responses, such as the booking hub SSE stream, are recorded chunk by
+    chunk with their timing. Cookies and credentials are never written to disk
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        :param path: The file where the recording is appended
+        """
+        super().__init__(**kwargs)
+        self._path = path
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def send(self, request, stream=False, **kwargs):
+        started = time.monotonic()
+        response = super().send(request, stream=stream, **kwargs)
+        keep_body = not any(path in request.url for path in _REDACTED_BODY_PATHS)
+        record = {
+            "t": round(started - self._start, 3),
+            "method": request.method,
+            "url": request.url,
+            "request_body": _encode(request.body) if keep_body else None,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: value for name, value in response.headers.items()
+                        if name.lower() not in _REDACTED_HEADERS},
+            "elapsed": round(response.elapsed.total_seconds(), 3),
+        }
+
+        if stream:
+            response.raw = _RecordingStream(response.raw, lambda chunks: self._write({**record, "chunks": chunks}))
+        else:
+            record["body"] = _encode(response.content)
+            self._write(record)
+        return response
+
+    def _write(self, record):
+        with self._lock, gzip.open(self._path, 'at', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+class _RecordingStream():
+    """
+    Wrapper of a raw streamed response recording the chunks read from it
+    """
+
+    def __init__(self, raw, on_close):
+        self._raw = raw
+        self._on_close = on_close
+        self._chunks = []
+        self._started = time.monotonic()
+        self._recorded = False
+
+    def stream(self, amt=None, decode_content=None):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._chunks.append([round(time.monotonic() - self._started, 3), _encode(chunk)])
+            yield chunk
+        self._record()
+
+    def close(self):
+        self._record()
+        self._raw.close()
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            self._on_close(self._chunks)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter answering requests with the responses of a recording. Responses are
+    matched by method and URL in recording order, so replays are deterministic. Latencies and
+    stream chunk timings are reproduced divided by the speed factor
+    """
+
+    def __init__(self, path: str, speed: float=1.0):
+        """
+        :param path: The recording file
+        :param speed: The timing acceleration factor. 0 replays without any delay
+        """
+        super().__init__()
+        self._speed = speed
+        self._lock = threading.Lock()
+        self._records = defaultdict(deque)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                self._records[(record["method"], record["url"])].append(record)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        with self._lock:
+            queue = self._records.get((request.method, request.url))
+            record = queue.popleft() if queue else None
+        if not record:
+            raise requests.exceptions.ConnectionError(f"No recorded response for {request.method} {request.url}",
+                                                      request=request)
+
+        _sleep(record["elapsed"], self._speed)
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.reason = record["reason"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        if "chunks" in record:
+            response.raw = _ReplayStream(record["chunks"], self._speed)
+        else:
+            response.raw = io.BytesIO(_decode(record["body"]))
+        return response
+
+    def close(self):
+        pass
+
+
+class _ReplayStream():
+    """
+    Raw streamed response yielding recorded chunks with their original timing
+    """
+
+    def __init__(self, chunks: list, speed: float):
+        self._chunks = chunks
+        self._speed = speed
+        self._closed = False
+
+    def stream(self, amt=None, decode_content=None):
+        started = time.monotonic()
+        for offset, chunk in self._chunks:
+            if self._closed:
+                return
+            _sleep(offset - (time.monotonic() - started) * (self._speed or 1), self._speed)
+            yield _decode(chunk)
+
+    def close(self):
+        self._closed = True
+
+
+def _sleep(seconds: float, speed: float) -> None:
+    if speed and seconds > 0:
+        time.sleep(seconds / speed)
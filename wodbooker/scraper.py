@@ -1,16 +1,33 @@
 import datetime
 import re
+import html
+import hashlib
+import random
 import pickle
 import logging
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
 import json
 import requests
 import sseclient
 import pytz
 from bs4 import BeautifulSoup
+try:
+    import orjson as _json_backend
+except ImportError:
+    _json_backend = json
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .models import db, Box
+from .cancellation import CancellationToken
+from .clock import get_clock
 from .exceptions import LoginError, InvalidWodBusterResponse, \
     BookingNotAvailable, ClassIsFull, PasswordRequired, InvalidBox, \
     ClassNotFound, BookingFailed
 
+_LOGGER = logging.getLogger(__name__)
+
 _HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0"
 }
@@ -19,6 +36,310 @@ _UTC_TZ = pytz.timezone('UTC')
 _MADRID_TZ = pytz.timezone('Europe/Madrid')
 _WODBUSTER_NOT_ACCEPTING_REQUESTS_MESSAGE = "WodBuster is not accepting more requests at this time. Try again in a minute"
 _MORE_THAN_ONE_BOX_MESSAGE = "User can access more than to boxes"
+_BOX_METADATA_MAX_AGE = datetime.timedelta(days=7)
+_SEATS_MAX_AGE = 5
+_SSE_IDLE_TIMEOUT = 35
+_SSE_RECONNECT_BASE_DELAY = 1
+_SSE_RECONNECT_MAX_DELAY = 60
+_SIGNALR_PING_INTERVAL = 15
+_SIGNALR_PING_MESSAGE = 6
+_SIGNALR_CLOSE_MESSAGE = 7
+_SIGNALR_RECORD_SEPARATOR = "\u001e"
+_LOGIN_FORM_FIELDS = ('__VIEWSTATEC', '__EVENTVALIDATION', 'CSRFToken')
+_INPUT_VALUE_REGEX = re.compile(r'\bvalue\s*=\s*"([^"]*)"')
+_TRANSPORT = None
+
+
+def parse_login_form(text: str) -> tuple:
+    """
+    Extract the hidden login form fields by looking up the input tags directly in the page,
+    avoiding a full DOM build
+    :param text: The login page HTML
+    :return: A tuple with the values of __VIEWSTATEC, __EVENTVALIDATION and CSRFToken or None
+    if any of them cannot be found
+    """
+    values = []
+    for field in _LOGIN_FORM_FIELDS:
+        id_index = text.find(f'id="{field}"')
+        if id_index < 0:
+            return None
+
+        tag_start = text.rfind('<', 0, id_index)
+        tag_end = text.find('>', id_index)
+        if tag_start < 0 or tag_end < 0 or not text.startswith('<input', tag_start):
+            return None
+
+        look_up = _INPUT_VALUE_REGEX.search(text, tag_start, tag_end)
+        if not look_up:
+            return None
+        values.append(html.unescape(look_up.group(1)))
+
+    return tuple(values)
+
+
+def parse_login_form_with_soup(content: bytes) -> tuple:
+    """
+    Extract the hidden login form fields by parsing the whole page with BeautifulSoup
+    :param content: The login page content
+    :return: A tuple with the values of __VIEWSTATEC, __EVENTVALIDATION and CSRFToken
+    :raises TypeError: If any of the fields cannot be found
+    """
+    soup = BeautifulSoup(content, 'lxml')
+    return tuple(soup.find(id=field)['value'] for field in _LOGIN_FORM_FIELDS)
+
+
+class DayClasses():
+    """
+    Classes returned by WodBuster for a given day. Classes are indexed by hour the first time
+    one of them is looked up, so every lookup on the same response is a dictionary access
+    """
+
+    def __init__(self, response: dict, epoch: int):
+        """
+        :param response: The response from WodBuster API for the day
+        :param epoch: The day in epoch format
+        """
+        self.response = response
+        self.epoch = epoch
+        self._classes_by_hour = None
+
+    def is_loaded(self) -> bool:
+        """
+        Returns True if the classes for the day have already been published
+        """
+        return bool(self.response.get('Data'))
+
+    def get_available_at(self) -> datetime.datetime:
+        """
+        Returns the datetime when the classes will be available or None if it's unknown
+        """
+        if "PrimeraHoraPublicacion" in self.response:
+            return _MADRID_TZ.localize(datetime.datetime.strptime(self.response["PrimeraHoraPublicacion"],
+                                                                  '%m/%d/%Y %H:%M:%S'))
+        return None
+
+    def get_class(self, hour: str) -> dict:
+        """
+        Returns the class for the given hour or None if there is no class at that hour
+        :param hour: The hour of the class in HH:MM:SS format
+        """
+        if self._classes_by_hour is None:
+            self._classes_by_hour = {}
+            # When several classes share an hour, the first one is booked
+            for _class in self.response.get('Data') or []:
+                self._classes_by_hour.setdefault(_class['Hora'], _class)
+        return self._classes_by_hour.get(hour)
+
+    def get_free_seats(self, hour: str) -> int:
+        """
+        Returns the number of free seats in the class for the given hour or None if there is no
+        class at that hour
+        :param hour: The hour of the class in HH:MM:SS format
+        """
+        _class = self.get_class(hour)
+        if not _class:
+            return None
+        class_details = _class['Valores'][0]['Valor']
+        return class_details['Plazas'] - len(class_details['AtletasEntrenando'])
+
+    def get_hours_by_class_id(self) -> dict:
+        """
+        Returns the hour in HH:MM:SS format of every class of the day by class id, as a string
+        """
+        return {str(_class['Valores'][0]['Valor']['Id']): _class['Hora'] for _class in self.response.get('Data') or []
+                if _class.get('Valores')}
+
+
+class _DayClassesCache():
+    """
+    Latest classes fetched for each box and day, shared by all the scrapers. Seat counts are the
+    same for every user, so concurrent lookups for the same box and day are coalesced into a
+    single fetch
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks_by_key = {}
+        self._classes_by_key = {}
+
+    def put(self, url: str, date: datetime.date, classes: DayClasses) -> None:
+        """
+        Store the classes fetched for a box and day
+        :param url: The WodBuster URL associated to the box
+        :param date: The day of the classes
+        :param classes: The fetched classes
+        """
+        with self._lock:
+            today = get_clock().now().date()
+            for key in [key for key in self._classes_by_key if key[1] < today]:
+                del self._classes_by_key[key]
+                self._locks_by_key.pop(key, None)
+            self._classes_by_key[(url, date)] = (get_clock().monotonic(), classes)
+
+    def get(self, url: str, date: datetime.date, max_age: int) -> DayClasses:
+        """
+        Returns the classes stored for a box and day or None if they are older than max_age
+        :param url: The WodBuster URL associated to the box
+        :param date: The day of the classes
+        :param max_age: The maximum age in seconds of the returned classes
+        """
+        with self._lock:
+            fetched_at, classes = self._classes_by_key.get((url, date), (None, None))
+        if fetched_at is not None and get_clock().monotonic() - fetched_at <= max_age:
+            return classes
+        return None
+
+    def get_or_fetch(self, url: str, date: datetime.date, max_age: int, fetch) -> DayClasses:
+        """
+        Returns the classes for a box and day, fetching them when they are older than max_age
+        :param url: The WodBuster URL associated to the box
+        :param date: The day of the classes
+        :param max_age: The maximum age in seconds of the returned classes
+        :param fetch: Function with no arguments fetching and storing the classes
+        """
+        key = (url, date)
+        with self._lock:
+            key_lock = self._locks_by_key.setdefault(key, threading.Lock())
+
+        with key_lock:
+            return self.get(url, date, max_age) or fetch()
+
+
+_DAY_CLASSES = _DayClassesCache()
+
+
+def get_cached_classes(url: str, date: datetime.date, max_age: int) -> DayClasses:
+    """
+    Returns the classes fetched by any user for a box and day in the last max_age seconds
+    :param url: The WodBuster URL associated to the box
+    :param date: The day of the classes
+    :param max_age: The maximum age in seconds of the returned classes
+    :return: The classes or None if they haven't been fetched recently
+    """
+    return _DAY_CLASSES.get(url, date, max_age)
+
+
+class SignalRRecord():
+    """
+    A record received from a SignalR hub. The type and the target of the record are looked up
+    in its header without decoding the whole record, which is only decoded when the data is required
+    """
+
+    _TYPE_REGEX = re.compile(r'"type"\s*:\s*(\d+)')
+    _TARGET_REGEX = re.compile(r'"target"\s*:\s*"([^"\\]*)"')
+
+    def __init__(self, raw: str):
+        """
+        :param raw: The JSON record without the record separator
+        """
+        self.raw = raw
+        self._data = None
+        # Invocation arguments may contain any key, so only the part before them is inspected
+        arguments_index = raw.find('"arguments"')
+        self._header_end = arguments_index if arguments_index >= 0 else len(raw)
+
+    def get_type(self) -> int:
+        """
+        Returns the type of the record or None if the record has no type
+        """
+        look_up = self._TYPE_REGEX.search(self.raw, 0, self._header_end)
+        if look_up:
+            return int(look_up.group(1))
+        return self.get_data().get("type") if self._header_end < len(self.raw) else None
+
+    def get_target(self) -> str:
+        """
+        Returns the target of the record or None if the record has no target
+        """
+        look_up = self._TARGET_REGEX.search(self.raw, 0, self._header_end)
+        if look_up:
+            return look_up.group(1)
+        return self.get_data().get("target") if '"target"' in self.raw else None
+
+    def get_data(self) -> dict:
+        """
+        Returns the decoded record
+        """
+        if self._data is None:
+            self._data = json.loads(self.raw)
+        return self._data
+
+
+class SignalRRecordSplitter():
+    """
+    Split the data received from a SignalR hub into records. Several records can be received in
+    the same message and a record can be split between several messages
+    """
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, data: str) -> list:
+        """
+        Add data received from the hub
+        :param data: The received data
+        :return: The list of records completed with the received data
+        """
+        chunks = (self._buffer + data).split(_SIGNALR_RECORD_SEPARATOR)
+        self._buffer = chunks.pop()
+        return [SignalRRecord(chunk) for chunk in chunks if chunk]
+
+
+class _SingleFlight():
+    """
+    Coalesce concurrent calls with the same key, so only the first one runs while the rest wait
+    for its outcome and share it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Run the function unless a call with the same key is already running, in which case its
+        result is returned or its exception raised once it finishes
+        :param key: The key identifying equivalent calls
+        :param fn: Function with no arguments
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = Future()
+                self._calls[key] = call
+
+        if not is_leader:
+            return call.result()
+
+        try:
+            result = fn()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def set_transport(adapter) -> None:
+    """
+    Set the transport adapter mounted on the sessions created from now on, e.g. to record the
+    traffic with WodBuster or to replay a recording
+    :param adapter: A requests transport adapter or None to use the default transport
+    """
+    global _TRANSPORT
+    _TRANSPORT = adapter
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    if _TRANSPORT:
+        session.mount("https://", _TRANSPORT)
+        session.mount("http://", _TRANSPORT)
+    return session
 
 
 class Scraper():
@@ -30,16 +351,32 @@ class Scraper():
         self._user = user
         self._password = password
         self.logged = False
-        self._session = requests.Session()
+        self._session = _new_session()
+        # Guards the serialization of the cookies against the replacement of the session
+        self._session_lock = threading.Lock()
         self._cookie = cookie
-        self._box_name_by_url = {}
-        self._sse_server_by_url = {}
+        self._last_book_latency = None
+        self._login_flight = _SingleFlight()
+
+    def close(self) -> None:
+        """
+        Close the pooled connections of the current session
+        """
+        self._session.close()
+
+    def get_last_book_latency(self) -> float:
+        """
+        Returns the number of seconds spent by the last booking attempt or None if no booking
+        has been attempted yet
+        """
+        return self._last_book_latency
 
     def get_cookies(self) -> bytes:
         """
         Returns the cookies for the current session
         """
-        return pickle.dumps(self._session.cookies)
+        with self._session_lock:
+            return pickle.dumps(self._session.cookies)
 
     def login(self) -> None:
         """
@@ -53,16 +390,23 @@ class Scraper():
         if self.logged:
             return
 
+        # Threads of the same user needing a login at the same time wait for a single login
+        self._login_flight.do(None, self._login)
+
+    def _login(self):
+        if self.logged:
+            return
+
         if self._cookie:
             self._session.cookies.update(pickle.loads(self._cookie))
             road_to_box_request = self._session.get("https://wodbuster.com/account/roadtobox.aspx",
                                                     headers=_HEADERS, allow_redirects=False, timeout=10)
 
             if "Location" in road_to_box_request.headers and "login" in road_to_box_request.headers["Location"]:
-                logging.warning("Cookie for user %s is outdated. Attempting logging with password...", self._user)
+                _LOGGER.warning("Cookie for user %s is outdated. Attempting logging with password...", self._user)
                 self._login_with_username_and_password()
             else:
-                logging.info("User %s logged successfully with cookie", self._user)
+                _LOGGER.info("User %s logged successfully with cookie", self._user)
                 self.logged = True
         else:
             self._login_with_username_and_password()
@@ -72,17 +416,19 @@ class Scraper():
         if not self._password:
             raise PasswordRequired("Password is required")
 
-        self._session = requests.Session()
+        # The new session replaces the current one only once logged, so requests in progress keep using the old one
+        session = _new_session()
         login_url = "https://wodbuster.com/account/login.aspx"
-        initial_request = self._session.get(login_url, headers=_HEADERS, timeout=10)
+        initial_request = session.get(login_url, headers=_HEADERS, timeout=10)
 
+        login_fields = parse_login_form(initial_request.text)
         try:
-            soup = BeautifulSoup(initial_request.content, 'lxml')
-            viewstatec = soup.find(id='__VIEWSTATEC')['value']
-            eventvalidation = soup.find(id='__EVENTVALIDATION')['value']
-            csrftoken = soup.find(id='CSRFToken')['value']
+            if not login_fields:
+                _LOGGER.warning("Login page fields not found. Falling back to full page parsing")
+                login_fields = parse_login_form_with_soup(initial_request.content)
+            viewstatec, eventvalidation, csrftoken = login_fields
         except TypeError as e:
-            logging.exception("WodBuster response cannot be parsed")
+            _LOGGER.exception("WodBuster response cannot be parsed")
             raise InvalidWodBusterResponse(_WODBUSTER_NOT_ACCEPTING_REQUESTS_MESSAGE) from e
 
         data_login = {
@@ -96,7 +442,7 @@ class Scraper():
             'ctl00$ctl00$body$body$CtlLogin$CtlAceptar': 'Aceptar\n'
         }
 
-        login_request = self._login_request(login_url, viewstatec, eventvalidation, csrftoken, data_login)
+        login_request = self._login_request(session, login_url, viewstatec, eventvalidation, csrftoken, data_login)
 
         if login_request.status_code != 200:
             raise InvalidWodBusterResponse(_WODBUSTER_NOT_ACCEPTING_REQUESTS_MESSAGE)
@@ -112,18 +458,23 @@ class Scraper():
             'ctl00$ctl00$body$body$CtlConfiar$CtlSeguro': 'Recordar\n'
         }
 
-        confirm_login_request = self._login_request(login_url, viewstatec_confirm,
+        confirm_login_request = self._login_request(session, login_url, viewstatec_confirm,
                                                     eventvalidation_confirm, csrftoken,
                                                     data_confirm)
 
         if confirm_login_request.status_code != 200:
             raise InvalidWodBusterResponse(_WODBUSTER_NOT_ACCEPTING_REQUESTS_MESSAGE)
 
-        logging.info("User %s logged successfully with credentials", self._user)
+        _LOGGER.info("User %s logged successfully with credentials", self._user)
+        with self._session_lock:
+            old_session, self._session = self._session, session
+        # Requests in progress on the old session finish, but its pooled connections are released
+        old_session.close()
         self.logged = True
         self._password = None
 
-    def _login_request(self, url, viewstatec, eventvalidation, csrftoken, extra_fields):
+    @staticmethod
+    def _login_request(session, url, viewstatec, eventvalidation, csrftoken, extra_fields):
         data = {
             'CSRFToken': csrftoken,
             '__EVENTTARGET': '',
@@ -136,7 +487,7 @@ class Scraper():
 
         data = {**data, **extra_fields}
 
-        request = self._session.post(url, data=data, headers=_HEADERS, timeout=10)
+        request = session.post(url, data=data, headers=_HEADERS, timeout=10)
         request.raise_for_status()
         return request
 
@@ -161,47 +512,79 @@ class Scraper():
         :raises ClassNotFound: If there is no class at the given date and time
         :raises BookingFailed: If the booking request fails
         """
-        self.login()
+        started = get_clock().monotonic()
+        try:
+            self.login()
+            classes = self.get_classes(url, booking_datetime.date())
+            return self._book_class(url, classes, booking_datetime)
+        finally:
+            self._last_book_latency = get_clock().monotonic() - started
+
+    def book_many(self, url: str, booking_datetimes: list) -> dict:
+        """
+        Book several classes at the given box for the same day, fetching the classes of the day once
+        :param url: The WodBuster URL associated to the box where the classes have to be booked
+        :param booking_datetimes: The dates and times of the classes to book. All of them must
+        belong to the same day
+        :return: A dict with the hour of each class in HH:MM:SS format as key. The value is True
+        if the class was booked or the exception that would have been raised by book otherwise
+        :raises LoginError: If user/password combination fails.
+        :raises InvalidWodBusterResponse: If the response from WodBuster is not valid (CloudFare
+        protection, etc.)
+        :raises PasswordRequired: If the provided cookie is outdated and a password is not provided
+        :raises RequestException: If a network error occurs or an HTTP error code is received
+        """
+        started = get_clock().monotonic()
+        try:
+            self.login()
+            classes = self.get_classes(url, booking_datetimes[0].date())
+
+            results = {}
+            for booking_datetime in booking_datetimes:
+                try:
+                    results[booking_datetime.strftime('%H:%M:%S')] = self._book_class(url, classes, booking_datetime)
+                except (BookingNotAvailable, ClassIsFull, ClassNotFound, BookingFailed,
+                        InvalidWodBusterResponse, InvalidBox) as e:
+                    results[booking_datetime.strftime('%H:%M:%S')] = e
+            return results
+        finally:
+            self._last_book_latency = get_clock().monotonic() - started
 
-        classes, epoch = self.get_classes(url, booking_datetime.date())
+    def _book_class(self, url: str, classes: DayClasses, booking_datetime: datetime) -> bool:
         hour = booking_datetime.strftime('%H:%M:%S')
 
-        if not classes['Data']:
-            avaiable_at = None
-            if "PrimeraHoraPublicacion" in classes:
-                avaiable_at = _MADRID_TZ.localize(datetime.datetime.strptime(classes["PrimeraHoraPublicacion"],
-                                                                             '%m/%d/%Y %H:%M:%S'))
-            raise BookingNotAvailable('No classes available', avaiable_at)
+        if not classes.is_loaded():
+            raise BookingNotAvailable('No classes available', classes.get_available_at())
 
-        for _class in classes['Data']:
-            if _class['Hora'] == hour:
-                class_status = _class['Valores'][0]['TipoEstado']
+        _class = classes.get_class(hour)
+        if not _class:
+            raise ClassNotFound(f"Class for {hour} not found on {booking_datetime.date().strftime('%d/%m/%Y')}")
 
-                if class_status == "Borrable":
-                    return True
+        class_status = _class['Valores'][0]['TipoEstado']
 
-                class_details = _class['Valores'][0]['Valor']
-                _id = class_details['Id']
-                if len(class_details['AtletasEntrenando']) >= class_details['Plazas']:
-                    raise ClassIsFull("Class is full")
+        if class_status == "Borrable":
+            return True
 
-                api_path = "Calendario_Mover.ashx" if class_status == "Cambiable" else "Calendario_Inscribir.ashx"
-                logging.info("Using API path %s to join user to class", api_path)
-                book_result = self._book_request(f'{url}/athlete/handlers/{api_path}?id={_id}&ticks={epoch}')
-                if book_result['Res']['EsCorrecto']:
-                    return True
-                else:
-                    raise BookingFailed(book_result.get("Res", {}).get("ErrorMsg"))
+        class_details = _class['Valores'][0]['Valor']
+        _id = class_details['Id']
+        if len(class_details['AtletasEntrenando']) >= class_details['Plazas']:
+            raise ClassIsFull("Class is full")
 
-        raise ClassNotFound(f"Class for {hour} not found on {booking_datetime.date().strftime('%d/%m/%Y')}")
+        api_path = "Calendario_Mover.ashx" if class_status == "Cambiable" else "Calendario_Inscribir.ashx"
+        _LOGGER.info("Using API path %s to join user to class", api_path)
+        book_result = self._book_request(f'{url}/athlete/handlers/{api_path}?id={_id}&ticks={classes.epoch}')
+        if book_result['Res']['EsCorrecto']:
+            return True
 
-    def get_classes(self, url: str, date: datetime.date) -> tuple:
+        raise BookingFailed(book_result.get("Res", {}).get("ErrorMsg"))
+
+    def get_classes(self, url: str, date: datetime.date) -> DayClasses:
         """ 
         Get the classes for a given epoch
         :param url: The WodBuster URL associated to the box where classes has to be obtained
         :param date: The day for which the classes have to be obtained
-        :return: A tuple. The first element is the response from WodBuster API for the specified date. 
-        The second element is the date in epoch format in case is useful for other operations
+        :return: The classes returned by WodBuster API for the specified date, together with the
+        date in epoch format in case is useful for other operations
         :raises BookingNotAvailable: If the class is not available for booking
         :raises ClassIsFull: If the class is full
         :raises LoginError: If user/password combination fails.
@@ -212,7 +595,27 @@ class Scraper():
         """
         midnight = _UTC_TZ.localize(datetime.datetime.combine(date, datetime.datetime.min.time()))
         epoch = int(midnight.timestamp())
-        return self._book_request(f'{url}/athlete/handlers/LoadClass.ashx?ticks={epoch}'), epoch
+        classes = DayClasses(self._book_request(f'{url}/athlete/handlers/LoadClass.ashx?ticks={epoch}'), epoch)
+        _DAY_CLASSES.put(url, date, classes)
+        return classes
+
+    def get_free_seats(self, url: str, class_datetime: datetime.datetime) -> int:
+        """
+        Get the number of free seats of a class. Classes fetched recently by any user for the same
+        box and day are reused
+        :param url: The WodBuster URL associated to the box
+        :param class_datetime: The date and time of the class
+        :return: The number of free seats or None if there is no class at the given date and time
+        :raises LoginError: If user/password combination fails.
+        :raises InvalidWodBusterResponse: If the response from WodBuster is not valid (CloudFare
+        protection, etc.)
+        :raises PasswordRequired: If the provided cookie is outdated and a password is not provided
+        :raises RequestException: If a network error occurs or an HTTP error code is received
+        """
+        self.login()
+        date = class_datetime.date()
+        classes = _DAY_CLASSES.get_or_fetch(url, date, _SEATS_MAX_AGE, lambda: self.get_classes(url, date))
+        return classes.get_free_seats(class_datetime.strftime('%H:%M:%S'))
 
     def _book_request(self, url):
         try:
@@ -222,14 +625,15 @@ class Scraper():
             if request.status_code != 200:
                 raise InvalidWodBusterResponse('Invalid response status from WodBuster')
 
-            return request.json()
-        except requests.exceptions.JSONDecodeError as e:
+            return _json_backend.loads(request.content)
+        except ValueError as e:
             raise InvalidWodBusterResponse('WodBuster returned a non JSON response') from e
         except requests.exceptions.RequestException as e:
             raise InvalidWodBusterResponse('WodBuster returned a non expected response') from e
 
     def wait_until_event(self, url: str, date: datetime.date, expected_events:list,
-                         max_datetime: datetime=None) -> bool:
+                         max_datetime: datetime=None, event_filter=None,
+                         cancellation: CancellationToken=None) -> bool:
         """ 
         Wait until a specific event is received for a given day
         :param url: The WodBuster URL associated to the box where the event will be received
@@ -237,6 +641,10 @@ class Scraper():
         :param expected_events: The list of event to wait for
         :param max_datetime: The maximum date when the event is expected. By default, events will 
         be waited until 23:59:59 of the provided date
+        :param event_filter: Optional function receiving the SignalRRecord of an expected event and
+        returning False when the event has to be ignored
+        :param cancellation: Optional token to cancel the wait. The event stream is closed as soon as
+        the token is cancelled
         :return: True if the event is found. False otherwise.
         :raises LoginError: If user/password combination fails.
         :raises InvalidWodBusterResponse: If the response from WodBuster is not valid (CloudFare
@@ -244,66 +652,136 @@ class Scraper():
         :raises PasswordRequired: If the provided cookie is outdated and a password is not provided
         :raises RequestException: If a network error occurs or an HTTP error code is received
         :raises InvalidBox: If box name cannot be determined from the provided URL
+        :raises OperationCancelled: If the cancellation token is cancelled while waiting
         """
         self.login()
+        cancellation = cancellation or CancellationToken()
         max_datetime = max_datetime or _MADRID_TZ.localize(datetime.datetime.combine(date, datetime.datetime.max.time()))
 
-        if url not in self._box_name_by_url:
-            homepage_request = self._session.get(f"{url}/user/", headers=_HEADERS,
-                                                 allow_redirects=False, timeout=10)
-            look_up = re.search(r"InitAjax\('([^']*)',\s?'([^']*)'", homepage_request.text)
-            if not look_up:
-                raise InvalidBox("Couldn't determine box name from URL")
-            self._box_name_by_url[url] = look_up.group(1)
-            self._sse_server_by_url[url] = look_up.group(2)
-
-        box_name = self._box_name_by_url[url]
-        sse_server = self._sse_server_by_url[url]
+        box_name, sse_server = self._get_box_metadata(url)
+        midnight = _UTC_TZ.localize(datetime.datetime.combine(date, datetime.datetime.min.time()))
+        epoch = int(midnight.timestamp())
         event_found = False
         timeout = False
+        failed_connections = 0
 
         while not event_found and not timeout:
-            negotiate_request = self._session.post(f"{sse_server}/bookinghub/negotiate?negotiateVersion=1",
-                                        headers=_HEADERS, timeout=10)
-            connection_token = negotiate_request.json()["connectionToken"]
+            if failed_connections:
+                delay = _get_reconnect_delay(failed_connections)
+                remaining_seconds = (max_datetime - get_clock().now(_MADRID_TZ)).total_seconds()
+                if remaining_seconds <= delay:
+                    # The wait would be over before reconnecting, so no new connection is opened
+                    cancellation.sleep(max(remaining_seconds, 0))
+                    timeout = True
+                    break
+                _SSE_RECONNECTS.increment(url)
+                _LOGGER.info("Reconnecting to %s in %.1f seconds", sse_server, delay)
+                cancellation.sleep(delay)
+
+            try:
+                negotiate_request = self._session.post(f"{sse_server}/bookinghub/negotiate?negotiateVersion=1",
+                                            headers=_HEADERS, timeout=10)
+                connection_token = negotiate_request.json()["connectionToken"]
+            except requests.exceptions.RequestException:
+                # The SSE server may have changed, so box metadata is resolved again on next attempt
+                _expire_box_metadata(url)
+                raise
             headers = {**_HEADERS, **{"Accept": "text/event-stream"}}
+            # SignalR pings every few seconds, so a read longer than the idle timeout means a dead stream
             booking_hub_request = self._session.get(f"{sse_server}/bookinghub?id={connection_token}",
-                                                    stream=True, headers=headers, timeout=60)
+                                                    stream=True, headers=headers,
+                                                    timeout=(10, _SSE_IDLE_TIMEOUT))
 
             self._send_sse_command(sse_server, connection_token, {"protocol":"json","version":1})
-            midnight = _UTC_TZ.localize(datetime.datetime.combine(date, datetime.datetime.min.time()))
-            epoch = int(midnight.timestamp())
             self._send_sse_command(sse_server, connection_token, {"arguments": [box_name, str(epoch)],
                                                                   "invocationId":"0",
                                                                   "target":"JoinRoom",
                                                                   "type":1})
+            last_ping_sent = get_clock().monotonic()
 
             client = sseclient.SSEClient(booking_hub_request)
             client_iterator = client.events()
+            splitter = SignalRRecordSplitter()
 
             connection_active = True
-            while connection_active and not event_found and not timeout:
-                if max_datetime and datetime.datetime.now(_MADRID_TZ) > max_datetime:
-                    timeout = True
-                else:
-                    try:
-                        event = next(client_iterator)
-                        data = json.loads(event.data[:-1])
-                        event_found = "target" in data and data["target"] in expected_events
-                    except StopIteration:
-                        logging.warning("Iterator without events. Reseting connection...")
-                        connection_active = False
-                    except requests.exceptions.ConnectionError:
-                        connection_active = False
-                        logging.warning("No event received after 60 seconds. Reseting connection")
-
-            client.close()
+            events_received = False
+            with cancellation.on_cancel(booking_hub_request.close):
+                try:
+                    while connection_active and not event_found and not timeout:
+                        if max_datetime and get_clock().now(_MADRID_TZ) > max_datetime:
+                            timeout = True
+                        else:
+                            try:
+                                event = next(client_iterator)
+                                for record in splitter.feed(event.data):
+                                    record_type = record.get_type()
+                                    # The handshake response has no type, so only later messages prove the stream is healthy
+                                    events_received = events_received or record_type is not None
+                                    if record_type == _SIGNALR_CLOSE_MESSAGE:
+                                        _LOGGER.warning("Connection closed by server: %s. Reseting connection...",
+                                                        record.get_data().get("error"))
+                                        connection_active = False
+                                    elif record.get_target() in expected_events:
+                                        event_found = event_filter is None or event_filter(record)
+                                        if event_found:
+                                            break
+
+                                if connection_active and get_clock().monotonic() - last_ping_sent > _SIGNALR_PING_INTERVAL:
+                                    self._send_sse_command(sse_server, connection_token, {"type": _SIGNALR_PING_MESSAGE})
+                                    last_ping_sent = get_clock().monotonic()
+                            except StopIteration:
+                                _LOGGER.warning("Iterator without events. Reseting connection...")
+                                connection_active = False
+                            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                                cancellation.raise_if_cancelled()
+                                connection_active = False
+                                _LOGGER.warning("No event received after %s seconds. Reseting connection",
+                                                _SSE_IDLE_TIMEOUT)
+                            except Exception:
+                                # Closing the stream from another thread may break the read in many ways
+                                cancellation.raise_if_cancelled()
+                                raise
+                finally:
+                    client.close()
+
+            cancellation.raise_if_cancelled()
+            # Streams dropped after being healthy are reconnected after the minimum delay
+            failed_connections = 1 if events_received else failed_connections + 1
 
         return event_found
 
+    def _get_box_metadata(self, url: str) -> tuple:
+        """
+        Get the box name and the SSE server of the given box. Metadata is shared by all the users
+        and persisted so the box homepage is only requested when it's unknown or outdated
+        :param url: The WodBuster URL associated to the box
+        :return: A tuple with the box name and the SSE server
+        :raises InvalidBox: If box name cannot be determined from the provided URL
+        """
+        table = Box.__table__
+        # Metadata is read and written in its own connection, so the session of the caller is not committed
+        with db.engine.connect() as conn:
+            box = conn.execute(select(table).where(table.c.url == url)).first()
+        if box and box.updated_at > get_clock().now() - _BOX_METADATA_MAX_AGE:
+            return box.name, box.sse_server
+
+        homepage_request = self._session.get(f"{url}/user/", headers=_HEADERS,
+                                             allow_redirects=False, timeout=10)
+        look_up = re.search(r"InitAjax\('([^']*)',\s?'([^']*)'", homepage_request.text)
+        if not look_up:
+            raise InvalidBox("Couldn't determine box name from URL")
+
+        box_name, sse_server = look_up.group(1), look_up.group(2)
+        values = {"name": box_name, "sse_server": sse_server, "updated_at": get_clock().now()}
+        # Users of the same box may resolve its metadata at the same time
+        with db.engine.begin() as conn:
+            conn.execute(sqlite_insert(table).values(url=url, **values)
+                         .on_conflict_do_update(index_elements=[table.c.url], set_=values))
+        return box_name, sse_server
+
     def _send_sse_command(self, sse_server, connection_token, command):
         headers = {**_HEADERS, **{"Content-Type": "text/plain"}}
-        command_str = json.dumps(command) + "\u001e"
+        command_str = json.dumps(command) + _SIGNALR_RECORD_SEPARATOR
         self._session.post(f"{sse_server}/bookinghub?id={connection_token}",
                            data=command_str, headers=headers, timeout=10)
 
@@ -328,7 +806,173 @@ class Scraper():
             raise InvalidWodBusterResponse(_MORE_THAN_ONE_BOX_MESSAGE)
 
 
-__SCRAPERS = {}
+def _expire_box_metadata(url: str) -> None:
+    """
+    Mark the persisted metadata of the given box as outdated
+    :param url: The WodBuster URL associated to the box
+    """
+    table = Box.__table__
+    with db.engine.begin() as conn:
+        conn.execute(update(table).where(table.c.url == url).values(updated_at=datetime.datetime.min))
+
+
+def _get_reconnect_delay(failed_connections: int) -> float:
+    """
+    Get the delay before reconnecting to the SSE server using exponential backoff with jitter
+    :param failed_connections: The number of consecutive failed connections
+    :return: The number of seconds to wait
+    """
+    max_delay = min(_SSE_RECONNECT_MAX_DELAY, _SSE_RECONNECT_BASE_DELAY * 2 ** (failed_connections - 1))
+    return random.uniform(_SSE_RECONNECT_BASE_DELAY, max_delay)
+
+
+class _Counter():
+    """
+    Thread-safe counter by key
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def increment(self, key: str) -> None:
+        """
+        Increment the count of the given key
+        :param key: The key to increment
+        """
+        with self._lock:
+            self._counts[key] += 1
+
+    def get_counts(self) -> dict:
+        """
+        Returns a copy of the counts by key
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+_SSE_RECONNECTS = _Counter()
+
+
+def get_sse_reconnects() -> dict:
+    """
+    Returns the number of reconnections to the SSE server by box URL since the app started
+    """
+    return _SSE_RECONNECTS.get_counts()
+
+
+class _ScraperRegistry():
+    """
+    Thread-safe registry of scrapers by user email. The least recently used scrapers are evicted
+    when the registry is full or when they have not been used for a while, closing their
+    connections. Scrapers held by running bookers are never evicted
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        """
+        :param max_size: The maximum number of scrapers kept in memory
+        :param ttl: The number of seconds a scraper is kept without being used
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._scrapers = OrderedDict()
+        self._last_access = {}
+        self._holders = Counter()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, email: str, factory) -> Scraper:
+        """
+        Returns the scraper for the given user, creating it with the factory if it doesn't exist
+        :param email: The email of the user
+        :param factory: Function with no arguments returning a new scraper
+        """
+        with self._lock:
+            self._evict_expired()
+            if email in self._scrapers:
+                self._hits += 1
+                self._touch(email)
+            else:
+                self._misses += 1
+                self._put(email, factory())
+            return self._scrapers[email]
+
+    def put(self, email: str, scraper: Scraper) -> None:
+        """
+        Store the scraper for the given user, replacing the existing one
+        :param email: The email of the user
+        :param scraper: The scraper to store
+        """
+        with self._lock:
+            old_scraper = self._scrapers.get(email)
+            if old_scraper is not None and old_scraper is not scraper:
+                old_scraper.close()
+            self._put(email, scraper)
+
+    def hold(self, email: str) -> None:
+        """
+        Keep the scraper of the given user while it's in use, e.g. by a booker waiting for days
+        :param email: The email of the user
+        """
+        with self._lock:
+            self._holders[email] += 1
+
+    def release(self, email: str) -> None:
+        """
+        Allow the scraper of the given user to be evicted again once every holder releases it
+        :param email: The email of the user
+        """
+        with self._lock:
+            self._holders[email] -= 1
+            if self._holders[email] <= 0:
+                del self._holders[email]
+            if email in self._scrapers:
+                self._touch(email)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the number of scrapers stored and the hits, misses and evictions so far
+        """
+        with self._lock:
+            return {"size": len(self._scrapers), "max_size": self._max_size,
+                    "hits": self._hits, "misses": self._misses, "evictions": self._evictions}
+
+    def _put(self, email, scraper):
+        self._scrapers[email] = scraper
+        self._touch(email)
+        while len(self._scrapers) > self._max_size:
+            idle_email = next((email for email in self._scrapers if not self._holders[email]), None)
+            if idle_email is None:
+                break
+            self._evict(idle_email)
+
+    def _touch(self, email):
+        self._scrapers.move_to_end(email)
+        self._last_access[email] = get_clock().monotonic()
+
+    def _evict_expired(self):
+        expiration = get_clock().monotonic() - self._ttl
+        for email in [email for email, last_access in self._last_access.items() if last_access <= expiration]:
+            if self._holders[email]:
+                self._touch(email)
+            else:
+                self._evict(email)
+
+    def _evict(self, email):
+        _LOGGER.info("Evicting scraper for user %s", email)
+        scraper = self._scrapers.pop(email)
+        del self._last_access[email]
+        scraper.close()
+        self._evictions += 1
+
+
+_MAX_SCRAPERS = 500
+_SCRAPER_TTL = 60 * 60 * 6
+
+__SCRAPERS = _ScraperRegistry(_MAX_SCRAPERS, _SCRAPER_TTL)
+__LOGINS = _SingleFlight()
 
 
 def get_scraper(email: str, cookie: bytes) -> Scraper:
@@ -338,10 +982,24 @@ def get_scraper(email: str, cookie: bytes) -> Scraper:
     :param: The user to get the scraper for
     :param: The cookie associated with the user
     """
-    if email not in __SCRAPERS:
-        __SCRAPERS[email] = Scraper(email, cookie=cookie)
+    return __SCRAPERS.get(email, lambda: Scraper(email, cookie=cookie))
+
+
+def hold_scraper(email: str) -> None:
+    """
+    Prevent the scraper of the given user from being evicted while it's in use. Every call must
+    be followed by a call to release_scraper
+    :param email: The email of the user
+    """
+    __SCRAPERS.hold(email)
+
 
-    return __SCRAPERS[email]
+def release_scraper(email: str) -> None:
+    """
+    Release the scraper of the given user held with hold_scraper
+    :param email: The email of the user
+    """
+    __SCRAPERS.release(email)
 
 
 def refresh_scraper(email: str, password: str) -> Scraper:
@@ -356,7 +1014,20 @@ def refresh_scraper(email: str, password: str) -> Scraper:
     protection, etc.)
     :raises RequestException: If a network error occurs or an HTTP error code is received
     """
+    # Repeated submissions of the same credentials share a single login
+    key = (email, hashlib.sha256(password.encode('utf-8')).hexdigest())
+    return __LOGINS.do(key, lambda: _login_new_scraper(email, password))
+
+
+def _login_new_scraper(email, password):
     scraper = Scraper(email, password)
     scraper.login()
-    __SCRAPERS[email] = scraper
+    __SCRAPERS.put(email, scraper)
     return scraper
+
+
+def get_scraper_stats() -> dict:
+    """
+    Returns the statistics of the scrapers registry: size, hits, misses and evictions
+    """
+    return __SCRAPERS.get_stats()
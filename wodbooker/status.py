@@ -0,0 +1,224 @@
+import queue
+import threading
+from .clock import get_clock
+
+_SUBSCRIPTION_QUEUE_SIZE = 100
+
+
+class BookingStatusIndex():
+    """
+    In-memory index with the state of every running booking. Bookers update it as they progress,
+    so the state of a booking is read without scanning its events. Every change is pushed to the
+    subscribers of the user owning the booking.
+
+    The state of a booking belongs to the loop which claimed it last, so a stopped loop finishing
+    an ongoing request never overwrites or removes the state of the loop replacing it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = {}
+        self._owners = {}
+        self._subscribers = {}
+        self._changes = {}
+
+    def claim(self, booking_id: int, owner, **values) -> None:
+        """
+        Start a new state for a booking, owned by the given loop
+        :param booking_id: The id of the booking
+        :param owner: The object identifying the loop running the booking
+        :param values: The fields of the initial state
+        """
+        with self._lock:
+            self._owners[booking_id] = owner
+            status = self._statuses[booking_id] = {
+                "booking_id": booking_id,
+                "user": None,
+                "url": None,
+                "state": None,
+                "waiter": None,
+                "deadline": None,
+                "errors": 0,
+                "last_attempt_latency": None,
+                "sse_active": False,
+                "last_event": None,
+                "last_event_date": None,
+            }
+            status.update(values)
+            status["updated_at"] = get_clock().now()
+            self._publish(status)
+            self._record_change(status)
+
+    def update(self, booking_id: int, owner, **values) -> None:
+        """
+        Update the state of a booking. Nothing is done if the state is owned by another loop
+        :param booking_id: The id of the booking
+        :param owner: The object identifying the loop running the booking
+        :param values: The fields of the state to update
+        """
+        with self._lock:
+            if self._owners.get(booking_id) is not owner:
+                return
+            status = self._statuses[booking_id]
+            status.update(values)
+            status["updated_at"] = get_clock().now()
+            self._publish(status)
+            self._record_change(status)
+
+    def remove(self, booking_id: int, owner) -> None:
+        """
+        Remove the state of a booking which is no longer running. Nothing is done if the state is
+        owned by another loop
+        :param booking_id: The id of the booking
+        :param owner: The object identifying the loop which was running the booking
+        """
+        with self._lock:
+            if self._owners.get(booking_id) is not owner:
+                return
+            del self._owners[booking_id]
+            status = self._statuses.pop(booking_id, None)
+            if status:
+                status = dict(status, state="stopped", waiter=None, deadline=None, sse_active=False,
+                              updated_at=get_clock().now())
+                self._publish(status)
+                self._record_change(status)
+
+    def get(self, booking_id: int) -> dict:
+        """
+        Returns a copy of the state of a booking or None if the booking is not running
+        :param booking_id: The id of the booking
+        """
+        with self._lock:
+            status = self._statuses.get(booking_id)
+            return dict(status) if status else None
+
+    def get_all(self, url: str=None, user: str=None) -> list:
+        """
+        Returns a copy of the state of the running bookings
+        :param url: If provided, only the bookings of this box are returned
+        :param user: If provided, only the bookings of the user with this email are returned
+        """
+        with self._lock:
+            return [dict(status) for status in self._statuses.values()
+                    if (url is None or status["url"] == url) and (user is None or status["user"] == user)]
+
+    def get_version(self, user: str) -> tuple:
+        """
+        Returns the number of changes of the bookings of a user and the date of the last one, removals
+        included, or (0, None) if none changed since the start
+        :param user: The email of the user
+        """
+        with self._lock:
+            return self._changes.get(user, (0, None))
+
+    def subscribe(self, user: str) -> queue.Queue:
+        """
+        Subscribe to the changes of the bookings of a user
+        :param user: The email of the user
+        :return: The queue where a copy of the state of a booking is put every time it changes
+        """
+        subscription = queue.Queue(_SUBSCRIPTION_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, user: str, subscription: queue.Queue) -> None:
+        """
+        Stop receiving the changes of the bookings of a user
+        :param user: The email of the user
+        :param subscription: The queue returned by subscribe
+        """
+        with self._lock:
+            subscriptions = self._subscribers.get(user, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscribers.pop(user, None)
+
+    def _record_change(self, status: dict) -> None:
+        version, _ = self._changes.get(status["user"], (0, None))
+        self._changes[status["user"]] = (version + 1, status["updated_at"])
+
+    def _publish(self, status: dict) -> None:
+        for subscription in self._subscribers.get(status["user"], []):
+            try:
+                subscription.put_nowait(dict(status))
+            except queue.Full:
+                # Slow subscribers miss intermediate changes instead of blocking the bookers
+                pass
+
+
+_STATUS_INDEX = BookingStatusIndex()
+
+
+def claim_booking_status(booking_id: int, owner, **values) -> None:
+    """
+    Start a new state for a booking whose loop is starting
+    :param booking_id: The id of the booking
+    :param owner: The object identifying the loop running the booking
+    :param values: The fields of the initial state
+    """
+    _STATUS_INDEX.claim(booking_id, owner, **values)
+
+
+def update_booking_status(booking_id: int, owner, **values) -> None:
+    """
+    Update the state of a running booking, unless it's owned by another loop
+    :param booking_id: The id of the booking
+    :param owner: The object identifying the loop running the booking
+    :param values: The fields of the state to update
+    """
+    _STATUS_INDEX.update(booking_id, owner, **values)
+
+
+def remove_booking_status(booking_id: int, owner) -> None:
+    """
+    Remove the state of a booking which is no longer running, unless it's owned by another loop
+    :param booking_id: The id of the booking
+    :param owner: The object identifying the loop which was running the booking
+    """
+    _STATUS_INDEX.remove(booking_id, owner)
+
+
+def get_booking_statuses_version(user: str) -> tuple:
+    """
+    Returns the number of changes of the state of the bookings of a user and the date of the last
+    one. Unlike the states, it also changes when a booking stops running
+    :param user: The email of the user
+    """
+    return _STATUS_INDEX.get_version(user)
+
+
+def subscribe_booking_statuses(user: str) -> queue.Queue:
+    """
+    Subscribe to the changes of the bookings of a user
+    :param user: The email of the user
+    :return: The queue receiving the state of a booking every time it changes
+    """
+    return _STATUS_INDEX.subscribe(user)
+
+
+def unsubscribe_booking_statuses(user: str, subscription: queue.Queue) -> None:
+    """
+    Stop receiving the changes of the bookings of a user
+    :param user: The email of the user
+    :param subscription: The queue returned by subscribe_booking_statuses
+    """
+    _STATUS_INDEX.unsubscribe(user, subscription)
+
+
+def get_booking_status(booking_id: int) -> dict:
+    """
+    Returns the state of a running booking or None if it's not running
+    :param booking_id: The id of the booking
+    """
+    return _STATUS_INDEX.get(booking_id)
+
+
+def get_booking_statuses(url: str=None, user: str=None) -> list:
+    """
+    Returns the state of the running bookings
+    :param url: If provided, only the bookings of this box are returned
+    :param user: If provided, only the bookings of the user with this email are returned
+    """
+    return _STATUS_INDEX.get_all(url, user)
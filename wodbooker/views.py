@@ -1,27 +1,45 @@
+import hmac
+import hashlib
+import json
+import queue
 import logging
 from datetime import datetime
 from collections import defaultdict
 import pickle
 import requests
-from flask import redirect, url_for, request, flash
+from flask import redirect, url_for, request, flash, jsonify, current_app, Response, \
+    make_response, session, g
 from wtforms import form, fields, validators
 from flask_admin.form.fields import TimeField
 import flask_login as login
-from flask_admin import AdminIndexView, helpers, expose
+from flask_admin import AdminIndexView, BaseView, helpers, expose
 from flask_admin.contrib import sqla
 from flask_admin.model.template import TemplateLinkRowAction
 from requests.exceptions import RequestException
-from sqlalchemy import and_
+from sqlalchemy import and_, tuple_, false, func
+from sqlalchemy.exc import SQLAlchemyError
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf
 from flask_wtf import Recaptcha
 from flask_wtf.recaptcha import RecaptchaField
-from .models import User, db, Booking
-from .booker import start_booking_loop, stop_booking_loop, is_booking_running
+from .models import User, db, Booking, Event, Schedule
+from .booker import start_booking_loop, stop_booking_loop, is_booking_running, start_booking_loops, \
+    stop_booking_loops
 from .scraper import refresh_scraper, get_scraper
+from .clock import get_clock
+from .jobs import submit_job, get_job, forget_job
+from .status import get_booking_status, get_booking_statuses, subscribe_booking_statuses, \
+    unsubscribe_booking_statuses, get_booking_statuses_version
 from .exceptions import LoginError, InvalidWodBusterResponse, PasswordRequired
 from .constants import EventMessage, DAYS_OF_WEEK
 
+_LOGGER = logging.getLogger(__name__)
+
 _MAX_BOOKINGS_BY_USER = 10
+_STATUS_STREAM_KEEPALIVE = 15
+# Streams are closed after this number of seconds so web workers are released. Browsers reconnect on their own
+_STATUS_STREAM_MAX_AGE = 5 * 60
+_BULK_BOOKING_FIELDS = ('dow', 'time', 'url', 'offset', 'available_at')
 
 
 class LoginForm(FlaskForm):
@@ -29,46 +47,55 @@ class LoginForm(FlaskForm):
     password = fields.PasswordField(validators=[validators.DataRequired()])
     recaptcha = RecaptchaField(validators=[Recaptcha("Verifica que no eres un robot")])
 
-    def __init__(self, formdata, **kwargs):
-        super().__init__(formdata=formdata, **kwargs)
-        self._scraper = None
-
-    def validate(self):
-        validation_result = FlaskForm.validate(self)
-        if not validation_result:
-            return False
 
+def _login(email, password):
+    """
+    Log the user into WodBuster. Run as a background job
+    :return: The cookies of the new session
+    """
+    return refresh_scraper(email, password).get_cookies()
+
+
+def _get_login_error_message(error):
+    if isinstance(error, LoginError):
+        return "Las credenciales introducidas son incorrectas"
+    if isinstance(error, InvalidWodBusterResponse):
+        return "La respuesta de WodBuster no fue la esperada. Inténtalo de nuevo en unos minutos..."
+    if isinstance(error, RequestException):
+        return "Error inesperado de red al intentar acceder. Inténtalo de nuevo en unos minutos..."
+    return "Error inesperado al intentar acceder. Inténtalo de nuevo en unos minutos..."
+
+
+def _get_or_create_user(email, cookie):
+    user = db.session.query(User).filter_by(email=email).first()
+    if not user:
+        user = User()
+        user.email = email
+        db.session.add(user)
+    user.cookie = cookie
+    user.force_login = False
+    db.session.commit()
+    return user
+
+
+def _store_box_url(app, user_id, email, cookie):
+    """
+    Look up the box URL of the user in WodBuster and cache it in the user. Run as a background job
+    """
+    with app.app_context():
         try:
-            self._scraper = refresh_scraper(self.email.data, self.password.data)
-        except LoginError:
-            logging.exception("Login Error")
-            self.password.errors.append("Las credenciales introducidas son incorrectas")
-            validation_result = False
-        except InvalidWodBusterResponse:
-            logging.exception("Invalid WodBuster Response")
-            self.password.errors.append("La respuesta de WodBuster no fue la esperada. Inténtalo de nuevo en unos minutos...")
-            validation_result = False
-        except RequestException:
-            logging.exception("Request Error")
-            self.password.errors.append("Error inesperado de red al intentar acceder. Inténtalo de nuevo en unos minutos...")
-            validation_result = False
-
-        return validation_result
-
-    def get_user(self):
-        existing_user = db.session.query(User).filter_by(email=self.email.data).first()
-        if existing_user:
-            existing_user.cookie = self._scraper.get_cookies()
-            existing_user.force_login = False
-            db.session.commit()
-            return existing_user
-        else:
-            user = User()
-            user.email = self.email.data
-            user.cookie = self._scraper.get_cookies()
-            db.session.add(user)
+            box_url = get_scraper(email, cookie).get_box_url()
+            db.session.query(User).filter_by(id=user_id).update({"box_url": box_url})
             db.session.commit()
-            return user
+        except (PasswordRequired, LoginError, InvalidWodBusterResponse, RequestException) as e:
+            _LOGGER.warning("Exception while loading BOX URL %s", e)
+        finally:
+            db.session.remove()
+
+
+def _request_box_url(user):
+    submit_job(_store_box_url, current_app._get_current_object(), user.id, user.email, user.cookie,
+               key=("box_url", user.id))
 
 
 # Create customized index view class that handles login & registration
@@ -86,17 +113,48 @@ class MyAdminIndexView(AdminIndexView):
 
     @expose('/login/', methods=('GET', 'POST'))
     def login_view(self):
-        # handle user login
+        # handle user login. WodBuster is reached in the background while the page polls for the result
         form = LoginForm(request.form)
         if helpers.validate_form_on_submit(form):
-            user = form.get_user()
-            login.login_user(user, remember=True)
+            session['login_job'] = submit_job(_login, form.email.data, form.password.data)
+            session['login_email'] = form.email.data
+            self._template_args['login_pending'] = True
 
         if login.current_user.is_authenticated:
             return redirect(url_for('booking.index_view'))
         self._template_args['form'] = form
         return super(MyAdminIndexView, self).index()
 
+    @expose('/login/status/')
+    def login_status_view(self):
+        """
+        Poll the result of the login started by login_view
+        """
+        job_id = session.get('login_job')
+        future = get_job(job_id) if job_id else None
+        if future and not future.done():
+            return jsonify(state="pending")
+
+        session.pop('login_job', None)
+        email = session.pop('login_email', None)
+        if job_id:
+            forget_job(job_id)
+        if not future:
+            flash("El intento de acceso ha caducado. Inténtalo de nuevo", "error")
+            return jsonify(state="error", redirect=url_for('.login_view'))
+
+        error = future.exception()
+        if error:
+            _LOGGER.warning("Login failed for user %s: %s", email, error)
+            flash(_get_login_error_message(error), "error")
+            return jsonify(state="error", redirect=url_for('.login_view'))
+
+        user = _get_or_create_user(email, future.result())
+        login.login_user(user, remember=True)
+        if not user.box_url:
+            _request_box_url(user)
+        return jsonify(state="done", redirect=url_for('booking.index_view'))
+
     @expose('/logout/')
     def logout_view(self):
         login.logout_user()
@@ -162,10 +220,214 @@ class BookingAdmin(sqla.ModelView):
         
         return redirect(url_for('booking.index_view'))
 
+    @expose('/')
+    def index_view(self):
+        """
+        List the bookings, answering with 304 Not Modified if nothing shown in the list has
+        changed since the version held by the client
+        """
+        etag, last_modified = self._get_list_validators()
+        not_modified = self._check_not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+        return self._make_conditional(make_response(super().index_view()), etag, last_modified)
+
+    @expose("/status")
+    def status_view(self):
+        """
+        Compact JSON state of the user bookings, with the same validators as the list
+        """
+        etag, last_modified = self._get_list_validators()
+        not_modified = self._check_not_modified(etag, last_modified)
+        if not_modified:
+            return not_modified
+
+        bookings = self.get_query().order_by(Booking.id).all()
+        response = jsonify([{
+            "id": booking.id,
+            "is_active": booking.is_active,
+            "is_running": is_booking_running(booking),
+            "state": (get_booking_status(booking.id) or {}).get("state") or ("stopped" if not booking.is_active else None),
+            "next_attempt": booking.schedule.fire_at.isoformat() if booking.schedule and is_booking_running(booking) else None,
+            "last_events": [{"date": event.date.isoformat(), "event": event.event}
+                            for event in self._get_last_events(booking.events)],
+        } for booking in bookings])
+        return self._make_conditional(response, etag, last_modified)
+
+    def _get_list_validators(self):
+        """
+        Compute the ETag and the last modification date of the bookings of the user from the
+        latest event id, the update time of the bookings and their schedules and the in-memory
+        state of the bookings, which changes without touching the database
+        """
+        user_id = login.current_user.id
+        last_event_id, last_event_date = db.session.query(func.max(Event.id), func.max(Event.date)) \
+            .join(Booking).filter(Booking.user_id == user_id).one()
+        bookings_count, bookings_updated_at, schedules_updated_at = db.session.query(
+            func.count(Booking.id), func.max(Booking.updated_at), func.max(Schedule.updated_at)) \
+            .outerjoin(Schedule).filter(Booking.user_id == user_id).one()
+        bookings = db.session.query(Booking.id).filter(Booking.user_id == user_id).order_by(Booking.id).all()
+        statuses = [get_booking_status(booking.id) or {} for booking in bookings]
+        running = [(booking.id, is_booking_running(booking), status.get("state"), status.get("sse_active"),
+                    status.get("updated_at")) for booking, status in zip(bookings, statuses)]
+        # Stopped bookings have no state left, so their removal is only seen in the version of the states
+        statuses_version, statuses_updated_at = get_booking_statuses_version(login.current_user.email)
+        # Pages embed CSRF tokens, so cached versions must expire before the tokens do
+        csrf_period = int(get_clock().now().timestamp() // ((current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2))
+
+        fingerprint = repr((user_id, last_event_id, bookings_count, bookings_updated_at, schedules_updated_at,
+                            running, statuses_version, csrf_period, g.get('version'), request.query_string))
+        last_modified = max(filter(None, (last_event_date, bookings_updated_at, schedules_updated_at,
+                                          statuses_updated_at)), default=None)
+        last_modified = last_modified.replace(microsecond=0).astimezone() if last_modified else None
+        return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest(), last_modified
+
+    @staticmethod
+    def _check_not_modified(etag, last_modified):
+        # Flashed messages are shown once, so they are never answered with a cached version
+        if '_flashes' in session:
+            return None
+        if request.if_none_match:
+            modified = not request.if_none_match.contains(etag)
+        elif request.if_modified_since and last_modified:
+            modified = last_modified > request.if_modified_since
+        else:
+            modified = True
+        return None if modified else BookingAdmin._make_conditional(Response(status=304), etag, last_modified)
+
+    @staticmethod
+    def _make_conditional(response, etag, last_modified):
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    @expose("/bulk", methods=("GET", "POST"))
+    def bulk_view(self):
+        """
+        JSON API managing many bookings at once. GET returns the bookings of the user and the CSRF
+        token required by POST. POST receives the bookings to create and update and the ids of the
+        bookings to pause and resume. All the changes are applied in a single transaction or none
+        is applied, and the booking loops are started and stopped as a batch afterwards
+        """
+        if request.method == "GET":
+            bookings = self.get_query().order_by(Booking.id).all()
+            return jsonify(csrf_token=generate_csrf(), bookings=[_serialize_booking(b) for b in bookings])
+
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify(errors=["Se esperaba un objeto JSON"]), 400
+
+        to_create, to_update = [], []
+        errors = []
+        if not all(isinstance(payload.get(name) or [], list) for name in ("create", "update")):
+            return jsonify(errors=["create y update deben ser listas de reservas"]), 400
+        for index, values in enumerate(payload.get("create") or []):
+            fields, field_errors = _parse_bulk_booking(values, partial=False)
+            to_create.append(fields)
+            errors.extend(f"create[{index}]: {error}" for error in field_errors)
+        for index, values in enumerate(payload.get("update") or []):
+            fields, field_errors = _parse_bulk_booking(values, partial=True)
+            if not isinstance(values, dict) or not _is_json_int(values.get("id")):
+                field_errors.append("id es obligatorio")
+            else:
+                fields["id"] = values["id"]
+            to_update.append(fields)
+            errors.extend(f"update[{index}]: {error}" for error in field_errors)
+        pause_ids = payload.get("pause") or []
+        resume_ids = payload.get("resume") or []
+        if not isinstance(pause_ids, list) or not isinstance(resume_ids, list) \
+                or not all(_is_json_int(_id) for _id in pause_ids + resume_ids):
+            errors.append("pause y resume deben ser listas de ids")
+        elif set(pause_ids) & set(resume_ids):
+            errors.append("Una reserva no puede pausarse y reanudarse a la vez")
+        if errors:
+            return jsonify(errors=errors), 400
+
+        # A single query loads every booking of the user, used both to authorize the changes and to detect duplicates
+        bookings = {booking.id: booking for booking in self.get_query().all()}
+        unknown_ids = {fields["id"] for fields in to_update} | set(pause_ids) | set(resume_ids)
+        unknown_ids -= bookings.keys()
+        if unknown_ids:
+            return jsonify(errors=[f"La reserva {_id} no existe" for _id in sorted(unknown_ids)]), 404
+        if len(bookings) + len(to_create) > _MAX_BOOKINGS_BY_USER:
+            return jsonify(errors=[f"Cada usuario puede crear como máximo {_MAX_BOOKINGS_BY_USER} reservas"]), 400
+
+        updated = {}
+        for fields in to_update:
+            booking = bookings[fields.pop("id")]
+            for name, value in fields.items():
+                setattr(booking, name, value)
+            updated[booking.id] = booking
+        for _id in pause_ids:
+            bookings[_id].is_active = False
+        for _id in resume_ids:
+            bookings[_id].is_active = True
+        created = [Booking(user=login.current_user, **fields) for fields in to_create]
+
+        keys = defaultdict(list)
+        for booking in list(bookings.values()) + created:
+            keys[(booking.dow, booking.url, booking.time)].append(booking)
+        duplicates = [DAYS_OF_WEEK[dow] + " " + booking_time.strftime('%H:%M') + " en " + url
+                      for (dow, url, booking_time), items in keys.items() if len(items) > 1]
+        if duplicates:
+            db.session.rollback()
+            return jsonify(errors=[f"Ya existe una reserva para {duplicate}" for duplicate in duplicates]), 409
+
+        try:
+            db.session.add_all(created)
+            db.session.commit()
+        except SQLAlchemyError:
+            _LOGGER.exception("Error while applying bulk booking changes")
+            db.session.rollback()
+            return jsonify(errors=["Error inesperado al guardar las reservas"]), 500
+
+        to_stop = [booking for booking in bookings.values()
+                   if (booking.id in updated or booking.id in pause_ids) and is_booking_running(booking)]
+        stop_booking_loops(to_stop, set(pause_ids))
+        start_booking_loops([booking for booking in list(bookings.values()) + created
+                             if booking.is_active and not is_booking_running(booking)
+                             and (booking.id in updated or booking.id in resume_ids or booking in created)])
+
+        return jsonify(created=[booking.id for booking in created], updated=sorted(updated),
+                       paused=sorted(pause_ids), resumed=sorted(resume_ids))
+
+    @expose("/stream")
+    def stream(self):
+        """
+        Stream the state of the user bookings as server-sent events. The current state of the
+        running bookings is sent first, followed by every change recorded by the bookers. The stream
+        is closed after a while and the browser opens a new one
+        """
+        user = login.current_user.email
+        # The stream only reads the in-memory status index, so the database connection is released at once
+        db.session.remove()
+
+        def generate():
+            subscription = subscribe_booking_statuses(user)
+            try:
+                for status in get_booking_statuses(user=user):
+                    yield _format_status_message(status)
+                deadline = get_clock().monotonic() + _STATUS_STREAM_MAX_AGE
+                while get_clock().monotonic() < deadline:
+                    try:
+                        timeout = min(_STATUS_STREAM_KEEPALIVE, deadline - get_clock().monotonic())
+                        status = subscription.get(timeout=max(timeout, 0))
+                        yield _format_status_message(status)
+                    except queue.Empty:
+                        yield ": keepalive\n\n"
+            finally:
+                unsubscribe_booking_statuses(user, subscription)
+
+        return Response(generate(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
     def get_list(self, *args, **kwargs):
         count, data = super().get_list(*args, **kwargs)
         for obj in data:
             obj.is_thread_active = is_booking_running(obj)
+            obj.status = get_booking_status(obj.id)
             obj.last_events = self._get_last_events(obj.events)
         return count, data
 
@@ -246,12 +508,11 @@ class BookingAdmin(sqla.ModelView):
                 form.url.data = form.url.data or last_booking.url
                 form.offset.data = form.offset.data or last_booking.offset
                 form.available_at.data = form.available_at.data or last_booking.available_at
+            elif login.current_user.box_url:
+                form.url.data = login.current_user.box_url
             else:
-                try:
-                    scraper = get_scraper(login.current_user.email, login.current_user.cookie)
-                    form.url.data = form.url.data or scraper.get_box_url()
-                except (PasswordRequired, LoginError, InvalidWodBusterResponse, RequestException) as e:
-                    logging.warning("Exception while loading BOX URL %s", e)
+                # The box URL is looked up in the background, so it's ready for the next form
+                _request_box_url(login.current_user)
 
         return form
 
@@ -263,6 +524,7 @@ class EventView(sqla.ModelView):
     can_edit = False
 
     column_searchable_list = ('booking_id',)
+    simple_list_pager = True
 
     list_template = 'admin/event/list.html'
 
@@ -282,6 +544,43 @@ class EventView(sqla.ModelView):
     def get_count_query(self):
         return super().get_count_query().join(Booking).filter(Booking.user_id==login.current_user.id)
 
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        """
+        List events using keyset pagination on (date, id) instead of offsets, so deep pages
+        don't scan the table. Searches match the booking id exactly so the index can be used.
+        The page is selected with the after/before cursors of the request
+        """
+        page_size = page_size or self.page_size
+        query = self.get_query()
+
+        if search:
+            booking_id = search.lstrip("=").strip()
+            query = query.filter(Event.booking_id == int(booking_id) if booking_id.isdigit() else false())
+
+        after = _parse_event_cursor(request.args.get('after'))
+        before = _parse_event_cursor(request.args.get('before'))
+        if before:
+            query = query.filter(tuple_(Event.date, Event.id) < before).order_by(Event.date.desc(), Event.id.desc())
+        else:
+            if after:
+                query = query.filter(tuple_(Event.date, Event.id) > after)
+            query = query.order_by(Event.date, Event.id)
+
+        if not execute:
+            return None, query
+
+        data = query.limit(page_size + 1).all()
+        has_more = len(data) > page_size
+        data = data[:page_size]
+        if before:
+            data.reverse()
+
+        next_cursor = data[-1] if data and (has_more or before) else None
+        previous_cursor = data[0] if data and ((has_more and before) or after) else None
+        self._template_args['next_cursor'] = _format_event_cursor(next_cursor)
+        self._template_args['previous_cursor'] = _format_event_cursor(previous_cursor)
+        return None, data
+
     def get_one(self, id):
         result = super().get_one(id)
         if result.booking.user_id != login.current_user.id:
@@ -354,6 +653,115 @@ class UserView(sqla.ModelView):
         return count, data
 
 
+class StatusView(BaseView):
+    """
+    JSON state of the running bookings. Users get the state of their own bookings, while
+    operators authenticated with the status API token can filter by box and user
+    """
+
+    def is_visible(self):
+        return False
+
+    def is_accessible(self):
+        return login.current_user.is_authenticated or _is_operator_request()
+
+    @expose('/')
+    def index(self):
+        user = request.args.get('user') if _is_operator_request() else login.current_user.email
+        statuses = get_booking_statuses(request.args.get('box'), user)
+        return jsonify([_serialize_status(status) for status in statuses])
+
+
+def _is_operator_request():
+    token = current_app.config.get('STATUS_API_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    # Bytes are compared as compare_digest rejects non-ASCII strings
+    return bool(token) and hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {token}".encode('utf-8'))
+
+
+def _serialize_status(status):
+    return dict(status,
+                deadline=status["deadline"].isoformat() if status["deadline"] else None,
+                last_event_date=status["last_event_date"].isoformat() if status["last_event_date"] else None,
+                updated_at=status["updated_at"].isoformat())
+
+
+def _format_status_message(status):
+    return f"data: {json.dumps(_serialize_status(status))}\n\n"
+
+
+def _parse_bulk_booking(values, partial):
+    """
+    Parse the fields of a booking received by the bulk API
+    :param values: The received JSON object
+    :param partial: If True, missing fields are allowed
+    :return: A tuple with the parsed fields and the list of errors
+    """
+    if not isinstance(values, dict):
+        return {}, ["Se esperaba un objeto JSON"]
+
+    fields, errors = {}, []
+    for name in _BULK_BOOKING_FIELDS:
+        if name not in values:
+            if not partial:
+                errors.append(f"{name} es obligatorio")
+            continue
+        value = values[name]
+        if name == "dow" and _is_json_int(value) and 0 <= value <= 6:
+            fields[name] = value
+        elif name == "offset" and _is_json_int(value) and value > 0:
+            fields[name] = value
+        elif name == "url" and isinstance(value, str) and 0 < len(value) <= 128:
+            fields[name] = value
+        elif name in ("time", "available_at") and isinstance(value, str) and _parse_time(value):
+            fields[name] = _parse_time(value)
+        else:
+            errors.append(f"{name} no es válido")
+    if "is_active" in values:
+        if isinstance(values["is_active"], bool) and not partial:
+            fields["is_active"] = values["is_active"]
+        else:
+            errors.append("is_active solo se admite al crear reservas. Usa pause y resume")
+    return fields, errors
+
+
+def _is_json_int(value):
+    # JSON booleans are parsed as bool, which is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(value, '%H:%M').time()
+    except ValueError:
+        return None
+
+
+def _serialize_booking(booking):
+    return {
+        "id": booking.id,
+        "dow": booking.dow,
+        "time": booking.time.strftime('%H:%M'),
+        "url": booking.url,
+        "offset": booking.offset,
+        "available_at": booking.available_at.strftime('%H:%M'),
+        "is_active": booking.is_active,
+        "last_book_date": booking.last_book_date.isoformat() if booking.last_book_date else None,
+    }
+
+
+def _format_event_cursor(event):
+    return f"{event.date.isoformat()}_{event.id}" if event else None
+
+
+def _parse_event_cursor(cursor):
+    try:
+        date, _id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(date), int(_id)
+    except (AttributeError, ValueError):
+        return None
+
+
 def _get_cookie_expiration_date(cookie):
     session = requests.Session()
     session.cookies.update(pickle.loads(cookie))